@@ -0,0 +1,298 @@
+# 批量提取对话中的拒学信息，结果逐行写入jsonl文件，可以断点续跑
+import argparse
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+import infra
+import extraction
+import batch_api
+
+# 记录已提交但还没有结束的批处理的文件，和输出文件放在一起
+BATCHES_SUFFIX = '.batches'
+
+
+def load_dialogs(source):
+    """
+    读取待处理的对话，返回(id, dialog)的生成器
+    source是目录时，目录下每个.txt文件是一段对话，文件名（不含后缀）作为id
+    source是jsonl文件时，每行需要包含dialog，id缺省时使用行号
+    """
+    if os.path.isdir(source):
+        for file_name in sorted(os.listdir(source)):
+            if not file_name.endswith('.txt'):
+                continue
+            with open(os.path.join(source, file_name), encoding='utf-8') as f:
+                yield file_name[:-4], f.read()
+    else:
+        with open(source, encoding='utf-8') as f:
+            for i, line in enumerate(f):
+                if not line.strip():
+                    continue
+                item = json.loads(line)
+                yield str(item.get('id', i)), item['dialog']
+
+
+def load_results(output_path):
+    """
+    读取输出文件，返回id到记录的字典
+    续跑时失败的对话会重新处理并追加一行，同一个id出现多次时以最后一行为准
+    """
+    results = {}
+    if not os.path.exists(output_path):
+        return results
+    with open(output_path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                item = json.loads(line)
+            except json.JSONDecodeError:
+                # 崩溃时最后一行可能只写了一半
+                continue
+            results[item['id']] = item
+    return results
+
+
+def load_done(output_path):
+    """读取已经完成的id，请求失败（最后一行是error）的记录不算完成，续跑时会重新发送"""
+    return {dialog_id for dialog_id, item in load_results(output_path).items() if item.get('status') != 'error'}
+
+
+def load_batches(path):
+    """读取还没有结束的批处理，返回批处理id到custom_id列表的字典"""
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_batches(path, batches):
+    """覆盖写入还没有结束的批处理，全部结束时删除文件"""
+    if not batches:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(batches, f, ensure_ascii=False)
+    os.replace(path + '.tmp', path)
+
+
+class BatchExtractor:
+    def __init__(self, service_info=None, concurrency=4, report_every=50, chunk_chars=extraction.MAX_CHUNK_CHARS):
+        self.service_info = service_info or extraction.EXTRACT_SERVICE
+        self.concurrency = concurrency
+        self.report_every = report_every
+        # 超过chunk_chars的对话分段提取再合并，为0时不分段
+        self.chunk_chars = chunk_chars
+        # 修复格式错误的结果，缺失的项单独重新请求
+        self.validator = extraction.ResultValidator(self.service_info)
+
+        # 每个工作线程使用自己的Service，避免多个线程读写同一个request的response_list
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+
+    def _get_service(self):
+        service = getattr(self._local, 'service', None)
+        if service is None:
+            service_info = self.service_info.copy()
+            service = infra.Service(service_info.pop('name'), service_info.pop('server'),
+                                    service_info.get('model', ''))
+            self._local.service = service
+        return service
+
+    def extract(self, dialog_id, dialog):
+        """提取一段对话，返回写入输出文件的记录"""
+        start = time.time()
+        item = {'id': dialog_id}
+        try:
+            if self.chunk_chars and len(dialog) > self.chunk_chars:
+                chunked = extraction.extract_chunked(dialog, self.service_info, max_chars=self.chunk_chars)
+                if chunked.failed:
+                    raise RuntimeError(f'{len(chunked.failed)}/{chunked.chunks}段提取失败')
+                item['result'] = chunked.result
+                item['chunks'] = chunked.chunks
+                item['status'] = 'ok'
+            else:
+                result = self._get_service().respond(extraction.build_messages(dialog), silent=True)
+                if not result:
+                    raise RuntimeError('模型没有返回结果')
+                self.check(item, result['show_msg'], dialog)
+        except Exception as e:
+            item['status'] = 'error'
+            item['error'] = f"{type(e).__name__}: {e}"
+        item['elapsed'] = round(time.time() - start, 3)
+        return item
+
+    def check(self, item, raw, dialog):
+        """校验模型返回的原文，把结果写入item"""
+        checked = self.validator.check(raw, dialog)
+        if checked.result:
+            item['result'] = checked.result
+            item['status'] = 'ok'
+            if checked.repaired:
+                item['repaired'] = True
+            if checked.reasked:
+                item['reasked'] = checked.reasked
+            if checked.failed:
+                item['missing'] = checked.failed
+        else:
+            # 已经付费拿到的结果，保留原文，续跑时不再重复发送
+            item['raw'] = raw
+            item['status'] = 'unparsed'
+
+    def run(self, source, output_path):
+        """
+        处理source中的所有对话，结果逐行追加到output_path
+        已经在output_path中完成的对话会被跳过
+        """
+        done = load_done(output_path)
+        stats = SimpleNamespace(finished=0, failed=0, skipped=0, elapsed=0, throughput=0)
+        # 限制同时在排队的对话数量，避免一次性把整个目录读进内存
+        slots = threading.BoundedSemaphore(self.concurrency * 2)
+        start = time.time()
+
+        def finish(future):
+            # work之外的错误（如写入输出文件失败）也计为失败，不能在线程池里被悄悄丢掉
+            error = future.exception()
+            if error is not None:
+                with self._write_lock:
+                    stats.failed += 1
+                print(f'{future.dialog_id}: {type(error).__name__}: {error}')
+
+        def work(dialog_id, dialog, output):
+            try:
+                item = self.extract(dialog_id, dialog)
+                with self._write_lock:
+                    output.write(json.dumps(item, ensure_ascii=False) + '\n')
+                    output.flush()
+                    stats.finished += 1
+                    if item['status'] == 'error':
+                        stats.failed += 1
+                    if stats.finished % self.report_every == 0:
+                        self._report(stats, time.time() - start)
+            finally:
+                slots.release()
+
+        with open(output_path, 'a', encoding='utf-8') as output, \
+                ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            for dialog_id, dialog in load_dialogs(source):
+                if dialog_id in done:
+                    stats.skipped += 1
+                    continue
+                slots.acquire()
+                future = executor.submit(work, dialog_id, dialog, output)
+                future.dialog_id = dialog_id
+                future.add_done_callback(finish)
+
+        stats.elapsed = time.time() - start
+        stats.validation = self.validator.stats()
+        self._report(stats, stats.elapsed)
+        print(f"repair_rate: {stats.validation['repair_rate']:.2%}, reask_rate: {stats.validation['reask_rate']:.2%}")
+        return stats
+
+    def run_batch(self, source, output_path, poll_interval=None, timeout=None):
+        """
+        使用服务商的批处理接口提取，价格更低，适合不急于拿到结果的离线任务
+        超过chunk_chars的对话在批处理提交后由线程池分段提取，和批处理同时进行
+        已提交的批处理id记录在output_path旁的.batches文件中，超时或中断后再次运行时继续等待这些批处理，不重新提交
+        """
+        done = load_done(output_path)
+        stats = SimpleNamespace(finished=0, failed=0, skipped=0, elapsed=0, throughput=0)
+        start = time.time()
+        request = self._get_service().request
+        submitter = batch_api.BatchSubmitter(request, poll_interval=poll_interval)
+        batches_path = output_path + BATCHES_SUFFIX
+        for batch_id, custom_ids in load_batches(batches_path).items():
+            custom_ids = [custom_id for custom_id in custom_ids if custom_id not in done]
+            if not custom_ids:
+                continue
+            try:
+                submitter.resume(batch_id, custom_ids)
+            except Exception as e:
+                print(f'无法继续批处理{batch_id}，其中的对话会重新提交：{type(e).__name__}: {e}')
+
+        dialogs = {}
+        long_dialogs = []
+        for dialog_id, dialog in load_dialogs(source):
+            if dialog_id in done:
+                stats.skipped += 1
+            elif dialog_id in submitter.futures:
+                dialogs[dialog_id] = dialog
+            elif self.chunk_chars and len(dialog) > self.chunk_chars:
+                long_dialogs.append((dialog_id, dialog))
+            else:
+                dialogs[dialog_id] = dialog
+                submitter.add(extraction.build_messages(dialog), custom_id=dialog_id)
+        if submitter.lines:
+            submitter.submit()
+        save_batches(batches_path, {batch_id: submitter.members[batch_id] for batch_id in submitter.batches})
+
+        with open(output_path, 'a', encoding='utf-8') as output, \
+                ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            def write(item):
+                with self._write_lock:
+                    output.write(json.dumps(item, ensure_ascii=False) + '\n')
+                    output.flush()
+                    stats.finished += 1
+                    if item['status'] == 'error':
+                        stats.failed += 1
+
+            long_futures = [executor.submit(lambda x: write(self.extract(*x)), item) for item in long_dialogs]
+            if submitter.batches:
+                try:
+                    submitter.wait(timeout)
+                except TimeoutError as e:
+                    # 批处理仍在服务端进行，下次运行时从.batches文件继续等待
+                    print(e)
+            for dialog_id, future in submitter.futures.items():
+                if not future.done():
+                    continue
+                item = {'id': dialog_id}
+                try:
+                    self.check(item, future.result().choices[0].message.content or '', dialogs.get(dialog_id, ''))
+                except Exception as e:
+                    item['status'] = 'error'
+                    item['error'] = f"{type(e).__name__}: {e}"
+                write(item)
+            for future in long_futures:
+                future.result()
+
+        save_batches(batches_path, {batch_id: submitter.members[batch_id] for batch_id in submitter.batches})
+        stats.elapsed = time.time() - start
+        stats.validation = self.validator.stats()
+        stats.batch = submitter.stats
+        self._report(stats, stats.elapsed)
+        submitter.count_usage()
+        return stats
+
+    @staticmethod
+    def _report(stats, elapsed):
+        stats.throughput = stats.finished / elapsed if elapsed > 0 else 0
+        print(f'finished: {stats.finished}, failed: {stats.failed}, skipped: {stats.skipped}, '
+              f'throughput: {stats.throughput:.2f} dialogs/s')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='批量提取对话中的拒学信息')
+    parser.add_argument('source', help='对话目录（*.txt）或jsonl文件（每行包含id和dialog）')
+    parser.add_argument('output', help='结果输出的jsonl文件，已存在时会跳过其中完成的对话')
+    parser.add_argument('--server', default=extraction.EXTRACT_SERVICE['server'])
+    parser.add_argument('--model', default=extraction.EXTRACT_SERVICE['model'])
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--chunk-chars', type=int, default=extraction.MAX_CHUNK_CHARS,
+                        help='超过这个长度的对话分段提取，为0时不分段')
+    parser.add_argument('--batch-api', action='store_true', help='使用服务商的批处理接口，价格更低但需要等待')
+    parser.add_argument('--poll-interval', type=float, default=batch_api.BATCH_CONFIG['poll_interval'])
+    args = parser.parse_args(argv)
+
+    service_info = {'name': args.server, 'server': args.server, 'model': args.model}
+    extractor = BatchExtractor(service_info, concurrency=args.concurrency, chunk_chars=args.chunk_chars)
+    if args.batch_api:
+        extractor.run_batch(args.source, args.output, poll_interval=args.poll_interval)
+    else:
+        extractor.run(args.source, args.output)
+
+
+if __name__ == '__main__':
+    main()
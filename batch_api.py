@@ -0,0 +1,293 @@
+# 服务商的异步批处理接口（OpenAI、qwen等兼容的/v1/batches）：价格更低、限额更高，适合离线的批量提取
+# 把多次Request.call的参数写成jsonl上传，轮询到完成后下载结果，再按custom_id交还给各自的调用方
+# LocalBatchBackend是本地的替身，不需要真实的服务商，用于测试和离线调试
+import io
+import json
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import Future
+from types import SimpleNamespace
+import mock_server
+import paradigm
+import statics
+
+BATCH_CONFIG = {
+    # 轮询批处理状态的间隔（秒）
+    'poll_interval': 30,
+    'completion_window': '24h',
+    # 一个批处理文件最多的请求数，超出时拆成多个批处理
+    'max_requests': 50000,
+    # 批处理相对同步调用的价格折扣
+    'discount': 0.5,
+}
+
+BATCH_ENDPOINT = '/v1/chat/completions'
+TERMINAL_STATUS = ('completed', 'failed', 'expired', 'cancelled')
+
+
+class BatchError(Exception):
+    """批处理中单个请求失败，或者整个批处理失败、过期"""
+
+
+class OpenAIBatchBackend:
+    """使用OpenAI兼容的files和batches接口，client是paradigm.get_client创建的客户端"""
+    def __init__(self, client):
+        self.client = client
+
+    def upload(self, text):
+        file = self.client.files.create(file=('batch.jsonl', io.BytesIO(text.encode('utf-8'))), purpose='batch')
+        return file.id
+
+    def create(self, file_id, completion_window):
+        return self.client.batches.create(input_file_id=file_id, endpoint=BATCH_ENDPOINT,
+                                          completion_window=completion_window)
+
+    def retrieve(self, batch_id):
+        return self.client.batches.retrieve(batch_id)
+
+    def download(self, file_id):
+        return self.client.files.content(file_id).text
+
+
+class LocalBatchBackend:
+    """
+    本地的批处理替身，文件保存在内存中，创建批处理后在后台线程逐行完成
+    request不为None时用它真实地发出请求（如连接mock_server的Request），否则用responder直接生成返回
+    """
+    def __init__(self, request=None, responder='echo', error_rate=0):
+        self.request = request
+        self.responder = responder
+        self.error_rate = error_rate
+        self.files = {}
+        self.batches = {}
+        self.lock = threading.Lock()
+
+    def upload(self, text):
+        file_id = f'file-{uuid.uuid4().hex[:12]}'
+        with self.lock:
+            self.files[file_id] = text
+        return file_id
+
+    def create(self, file_id, completion_window):
+        lines = [json.loads(line) for line in self.files[file_id].splitlines() if line.strip()]
+        batch = SimpleNamespace(id=f'batch_{uuid.uuid4().hex[:12]}', status='in_progress', input_file_id=file_id,
+                                output_file_id=None, error_file_id=None,
+                                request_counts=SimpleNamespace(total=len(lines), completed=0, failed=0))
+        with self.lock:
+            self.batches[batch.id] = batch
+        threading.Thread(target=self._process, args=(batch, lines), daemon=True).start()
+        return batch
+
+    def retrieve(self, batch_id):
+        with self.lock:
+            return self.batches[batch_id]
+
+    def download(self, file_id):
+        with self.lock:
+            return self.files[file_id]
+
+    def complete(self, params):
+        if self.request is not None:
+            # 直接使用客户端，批处理的用量由BatchSubmitter按折扣价统计，不计入request
+            return self.request.client.chat.completions.create(**params).model_dump(exclude_none=True)
+        if self.error_rate and random.random() < self.error_rate:
+            raise BatchError('mock error')
+        responder = self.responder if callable(self.responder) else mock_server.RESPONDERS[self.responder]
+        return mock_server.build_completion(params, {'role': 'assistant', 'content': responder(params)})
+
+    def _process(self, batch, lines):
+        output = []
+        errors = []
+        for line in lines:
+            try:
+                body = self.complete(line['body'])
+            except Exception as e:
+                errors.append({'id': f'batch_req_{uuid.uuid4().hex[:12]}', 'custom_id': line['custom_id'],
+                               'response': None, 'error': {'code': type(e).__name__, 'message': str(e)}})
+                batch.request_counts.failed += 1
+                continue
+            output.append({'id': f'batch_req_{uuid.uuid4().hex[:12]}', 'custom_id': line['custom_id'],
+                           'response': {'status_code': 200, 'body': body}, 'error': None})
+            batch.request_counts.completed += 1
+        if output:
+            batch.output_file_id = self.upload(dumps_lines(output))
+        if errors:
+            batch.error_file_id = self.upload(dumps_lines(errors))
+        batch.status = 'completed'
+
+
+def dumps_lines(items):
+    return ''.join(json.dumps(item, ensure_ascii=False) + '\n' for item in items)
+
+
+_local_backends = {}
+
+
+def get_backend(request):
+    """
+    mock server没有批处理接口，使用本地替身，其余server使用OpenAI兼容接口
+    同一个进程中连接同一个地址的替身共用，之前提交的批处理可以继续查询
+    """
+    if request.server == 'mock':
+        backend = _local_backends.get(request._base)
+        if backend is None:
+            backend = _local_backends[request._base] = LocalBatchBackend(request)
+        return backend
+    return OpenAIBatchBackend(request.client)
+
+
+class BatchSubmitter:
+    """
+    收集多次请求，一次性以批处理提交：
+        submitter = BatchSubmitter(paradigm.Request('qwen', 'qwen-plus'))
+        future = submitter.add(messages, temperature=0)
+        submitter.run()
+        response = future.result()  # ChatCompletion，失败时抛出BatchError
+    backend为None时按request.server选择
+    """
+    def __init__(self, request, backend=None, poll_interval=None, completion_window=None):
+        self.request = request
+        self.backend = backend or get_backend(request)
+        self.poll_interval = BATCH_CONFIG['poll_interval'] if poll_interval is None else poll_interval
+        self.completion_window = completion_window or BATCH_CONFIG['completion_window']
+
+        self.lines = []
+        self.futures = {}
+        # 还没有结束的批处理id，以及每个批处理包含的custom_id
+        self.batches = []
+        self.members = {}
+        self.finished = []
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.stats = {'requests': 0, 'completed': 0, 'failed': 0, 'batches': 0}
+
+    def add(self, messages, custom_id=None, **kwargs):
+        """添加一次请求，参数和Request.call相同（不支持流式），返回在结果下载后完成的Future"""
+        kwargs.pop('stream', None)
+        custom_id = custom_id or f'request-{len(self.futures)}'
+        if custom_id in self.futures:
+            raise ValueError(f'重复的custom_id：{custom_id}')
+        params = self.request.build_params(messages, **kwargs)
+        self.lines.append({'custom_id': custom_id, 'method': 'POST', 'url': BATCH_ENDPOINT, 'body': params})
+        self.stats['requests'] += 1
+        return self.track(custom_id)
+
+    def track(self, custom_id):
+        future = Future()
+        future.custom_id = custom_id
+        self.futures[custom_id] = future
+        return future
+
+    def resume(self, batch_id, custom_ids):
+        """
+        继续等待之前提交的批处理，返回custom_id到Future的字典
+        批处理不存在时抛出服务商的错误，这些请求需要重新add
+        """
+        self.backend.retrieve(batch_id)
+        futures = {}
+        for custom_id in custom_ids:
+            if custom_id in self.futures:
+                raise ValueError(f'重复的custom_id：{custom_id}')
+            futures[custom_id] = self.track(custom_id)
+        self.batches.append(batch_id)
+        self.members[batch_id] = list(custom_ids)
+        self.stats['requests'] += len(futures)
+        return futures
+
+    def submit(self):
+        """上传还没有提交的请求，超过max_requests时拆成多个批处理，返回批处理id"""
+        ids = []
+        max_requests = BATCH_CONFIG['max_requests']
+        for i in range(0, len(self.lines), max_requests):
+            lines = self.lines[i:i + max_requests]
+            file_id = self.backend.upload(dumps_lines(lines))
+            batch = self.backend.create(file_id, self.completion_window)
+            self.batches.append(batch.id)
+            self.members[batch.id] = [line['custom_id'] for line in lines]
+            ids.append(batch.id)
+            self.stats['batches'] += 1
+        self.lines = []
+        return ids
+
+    def wait(self, timeout=None):
+        """
+        轮询到所有批处理结束，下载结果并完成对应的Future；超时时抛出TimeoutError
+        结束的批处理移到finished，超时后batches中是仍在进行的批处理
+        """
+        deadline = time.time() + timeout if timeout else None
+        while self.batches:
+            for batch_id in list(self.batches):
+                batch = self.backend.retrieve(batch_id)
+                if batch.status in TERMINAL_STATUS:
+                    self.collect(batch)
+                    self.batches.remove(batch_id)
+                    self.finished.append(batch_id)
+            if not self.batches:
+                break
+            if deadline and time.time() + self.poll_interval > deadline:
+                raise TimeoutError(f'批处理没有在{timeout}秒内完成：{self.batches}')
+            time.sleep(self.poll_interval)
+        # 批处理失败、过期或取消时，没有结果的请求也要通知调用方
+        for future in self.futures.values():
+            if not future.done():
+                self.fail(future, BatchError('批处理结束时没有返回结果'))
+
+    def collect(self, batch):
+        from openai.types.chat import ChatCompletion
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if not file_id:
+                continue
+            for line in self.backend.download(file_id).splitlines():
+                if not line.strip():
+                    continue
+                item = json.loads(line)
+                future = self.futures.get(item.get('custom_id'))
+                if future is None or future.done():
+                    continue
+                response = item.get('response') or {}
+                if item.get('error') or response.get('status_code') != 200:
+                    self.fail(future, BatchError(str(item.get('error') or response.get('body'))))
+                    continue
+                completion = ChatCompletion.model_validate(response['body'])
+                usage = completion.usage
+                if usage:
+                    self.prompt_tokens += usage.prompt_tokens or 0
+                    self.completion_tokens += usage.completion_tokens or 0
+                self.stats['completed'] += 1
+                future.set_result(completion)
+        if batch.status != 'completed':
+            print(f'批处理{batch.id}结束，状态：{batch.status}')
+
+    def fail(self, future, error):
+        self.stats['failed'] += 1
+        future.set_exception(error)
+
+    def run(self, timeout=None):
+        """提交并等待完成，返回custom_id到Future的字典"""
+        self.submit()
+        self.wait(timeout)
+        return self.futures
+
+    def fee(self):
+        fee = statics.compute_fee(self.request.fee_model(), paradigm.MODEL_FEE, self.prompt_tokens,
+                                  self.completion_tokens)
+        return fee * BATCH_CONFIG['discount'] if fee is not None else None
+
+    def count_usage(self):
+        print(f'prompt_tokens: {self.prompt_tokens}')
+        print(f'completion_tokens: {self.completion_tokens}')
+        fee = self.fee()
+        if fee is not None:
+            print(f'total_fee: {fee}')
+        print(f'batch: {self.stats}')
+
+
+if __name__ == '__main__':
+    submitter = BatchSubmitter(paradigm.Request('mock'), backend=LocalBatchBackend(), poll_interval=0.1)
+    futures = [submitter.add([{'role': 'user', 'content': f'第{i}个问题'}]) for i in range(3)]
+    submitter.run()
+    for future in futures:
+        print(future.custom_id, future.result().choices[0].message.content)
+    submitter.count_usage()
@@ -0,0 +1,409 @@
+# 编排层自身开销的性能测试，不会请求真实的API
+# python benchmark.py --save 把结果保存到.benchmarks/<commit>.json，--compare <commit> 和之前保存的结果对比
+import argparse
+import contextlib
+import copy
+import io
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from types import SimpleNamespace
+from openai.types.chat import ChatCompletion
+import infra
+import multi_talk
+import paradigm
+import statics
+
+# 只是为了能创建客户端，不会真正发出请求
+os.environ.setdefault('QWEN_API_KEY', 'benchmark')
+
+
+def legacy_related_context(talk, service, use_tools=False):
+    """改为增量索引之前的实现：每次遍历全部记录、排序并深拷贝，作为对比基准"""
+    related = []
+    for record in talk.records:
+        if not use_tools and record.sender == 'tools':
+            continue
+        if record.check(service):
+            related.append(record)
+    context = []
+    for record in sorted(related, key=lambda x: x.order):
+        msg = copy.deepcopy(record.msg)
+        if record.sender not in ['user', 'system', 'tools'] and record.sender != service.name:
+            msg['role'] = record.sender
+        context.append(msg)
+    return context
+
+
+class LegacyTalkRecord:
+    """改为__slots__之前的TalkRecord，作为内存对比基准"""
+    def __init__(self, order, msg, sender='user', display_to=['all']):
+        self.order = order
+        self.sender = sender
+        self.display_to = display_to
+        self.msg = msg
+
+
+def build_talk(history, services=3):
+    """创建一个已有history条记录的Talk，消息在公开、私聊和工具返回之间轮换"""
+    services_list = [{'name': f'service_{i}', 'server': 'qwen'} for i in range(services)]
+    talk = multi_talk.Talk(services_list, system_prompt='你是一个参与讨论的角色')
+    names = [service['name'] for service in services_list]
+    for i in range(history):
+        name = names[i % services]
+        msg = {'role': 'assistant', 'content': f'第{i}条消息，' * 8}
+        match i % 4:
+            case 0:
+                talk.add_record(multi_talk.TalkRecord(i, {'role': 'user', 'content': f'第{i}个问题'}))
+            case 1:
+                talk.add_record(multi_talk.TalkRecord(i, msg, name))
+            case 2:
+                talk.add_record(multi_talk.TalkRecord(i, msg, name, [name]))
+            case 3:
+                talk.add_record(multi_talk.TalkRecord(i, msg, 'tools', [name]))
+    talk.current_order = history
+    return talk
+
+
+def timeit(func, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat
+
+
+def bench_related_context(history_sizes=(100, 1000, 10000), turns=20):
+    """
+    模拟多轮对话：每一轮添加一条新记录，再为一个service构建发送的消息
+    返回每种历史长度下单轮的平均耗时（毫秒）
+    索引去掉了每轮的筛选和排序，但构建消息列表仍然是线性的，per_record_us是单轮耗时除以历史长度，大致不变说明是线性增长
+    """
+    results = []
+    for history in history_sizes:
+        talk = build_talk(history)
+        service = talk.services[0]
+        # 第一次调用建立索引
+        talk.map_task_messages(service, '1on1')
+
+        def turn():
+            talk.add_record(multi_talk.TalkRecord(talk.current_order, {'role': 'user', 'content': '新的问题'}))
+            talk.current_order += 1
+            talk.map_task_messages(service, '1on1')
+
+        def legacy_turn():
+            legacy_related_context(talk, service)
+
+        turn_ms = timeit(turn, turns) * 1000
+        results.append({
+            'history': history,
+            'turn_ms': turn_ms,
+            'per_record_us': turn_ms * 1000 / history,
+            'legacy_turn_ms': timeit(legacy_turn, max(turns // 4, 1)) * 1000,
+        })
+    return results
+
+
+def bench_record_size(count=10000, services=3):
+    """每条记录本身占用的字节数（不含消息内容），私聊记录的display_to各自是一个新的list"""
+    names = [f'service_{i}' for i in range(services)]
+    messages = [{'role': 'assistant', 'content': f'第{i}条消息'} for i in range(count)]
+
+    def measure(record_class, talk=None):
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        records = []
+        for i, msg in enumerate(messages):
+            # 运行时拼出来的名字，和从接口返回的名字一样不是同一个对象
+            name = ''.join(['service_', str(i % services)])
+            display_to = ['all'] if i % 2 else [name]
+            record = record_class(i, msg, name, display_to)
+            if talk:
+                talk.record_mask(record)
+            records.append(record)
+        size = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+        return size / count
+
+    talk = multi_talk.Talk([{'name': name, 'server': 'qwen'} for name in names])
+    return [{
+        'records': count,
+        'legacy_bytes': measure(LegacyTalkRecord),
+        'bytes': measure(multi_talk.TalkRecord, talk),
+    }]
+
+
+class FakeRequest(paradigm.Request):
+    """
+    没有网络延迟的Request：保留参数组装、缓存、用量统计等全部流程，只把发出请求换成立即返回固定的结果
+    请求带有tools时，按tool_call_rate的比例返回tool_call
+    """
+    def __init__(self, model='fake', tool_call_rate=0, seed=0):
+        super().__init__('mock', model, response_cache=False)
+        self.tool_call_rate = tool_call_rate
+        self.random = random.Random(seed)
+
+    def attempt(self, params, kwargs, timeout=None):
+        tools = params.get('tools')
+        if tools and params.get('tool_choice') != 'none' and self.random.random() < self.tool_call_rate:
+            return fake_completion(tool=tools[0]['function']['name'])
+        return fake_completion()
+
+
+_completions = {}
+
+
+def fake_completion(tool=None):
+    """同样的返回只创建一次，避免把创建返回对象的时间算进编排层的开销"""
+    if tool not in _completions:
+        message = {'role': 'assistant', 'content': '好的，这是我的回答。'}
+        if tool:
+            message = {'role': 'assistant', 'content': None, 'tool_calls': [
+                {'id': 'call_0', 'type': 'function', 'function': {'name': tool, 'arguments': '{}'}}]}
+        _completions[tool] = ChatCompletion.model_validate({
+            'id': 'fake', 'object': 'chat.completion', 'created': 0, 'model': 'fake',
+            'choices': [{'index': 0, 'finish_reason': 'tool_calls' if tool else 'stop', 'message': message}],
+            'usage': {'prompt_tokens': 10, 'completion_tokens': 10, 'total_tokens': 20},
+        })
+    return _completions[tool]
+
+
+def use_fake_requests(services, tool_call_rate=0, tools=0):
+    """把service的Request换成FakeRequest，并注册tools个工具"""
+    for i, service in enumerate(services):
+        service.request = FakeRequest(tool_call_rate=tool_call_rate, seed=i)
+        if tools:
+            service.add_tools([infra.Function(f'tool_{j}', [{'name': 'query', 'type': 'string',
+                                                               'description': '查询内容', 'required': True}],
+                                              f'第{j}个工具') for j in range(tools)])
+            service.set_params({'tool_choice': 'auto'})
+
+
+def timeit_quiet(func, repeat):
+    """service默认会打印回复，计时时丢弃输出"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        return timeit(func, repeat)
+
+
+def bench_merge_params(tool_counts=(0, 10, 50), repeat=2000):
+    """每次请求前Service.merge_params对params的深拷贝，tools越多越慢"""
+    results = []
+    for tools in tool_counts:
+        service = infra.Service('service', 'mock')
+        use_fake_requests([service], tools=tools)
+        results.append({
+            'tools': tools,
+            'merge_params_ms': timeit(lambda: service.merge_params({'temperature': 0.5}), repeat) * 1000,
+        })
+    return results
+
+
+def bench_task_assign(service_counts=(1, 4, 16), tool_call_rates=(0, 0.5), rounds=20):
+    """Task.assign一轮的耗时：每个service一个线程、请求（无延迟）、Task.receive处理返回"""
+    results = []
+    messages = [{'role': 'user', 'content': '你好'}]
+    for services in service_counts:
+        for tool_call_rate in tool_call_rates:
+            task = infra.Task([{'name': f'service_{i}', 'server': 'mock'} for i in range(services)])
+            use_fake_requests(task.services, tool_call_rate, tools=2 if tool_call_rate else 0)
+            results.append({
+                'services': services,
+                'tool_call_rate': tool_call_rate,
+                'round_ms': timeit_quiet(lambda: task.assign(messages), rounds) * 1000,
+            })
+    return results
+
+
+def bench_talk_round(service_counts=(1, 4, 16), history_sizes=(100, 1000), tool_call_rates=(0, 0.5), rounds=10):
+    """Talk一轮对话的耗时：send、为每个service构建上下文、并发请求、receive处理返回和tool_call"""
+    results = []
+    for services in service_counts:
+        for history in history_sizes:
+            for tool_call_rate in tool_call_rates:
+                talk = build_talk(history, services)
+                use_fake_requests(talk.services, tool_call_rate, tools=2 if tool_call_rate else 0)
+
+                def round_():
+                    talk.send('新的问题')
+                    talk.assign()
+
+                results.append({
+                    'services': services,
+                    'history': history,
+                    'tool_call_rate': tool_call_rate,
+                    'round_ms': timeit_quiet(round_, rounds) * 1000,
+                })
+    return results
+
+
+def bench_merge_adjacent(history_sizes=(100, 1000, 10000), repeat=20):
+    """statics.merge_adjacent_messages_with_same_role，每五条消息中有两条相邻的同角色消息"""
+    results = []
+    for history in history_sizes:
+        messages = [{'role': 'user' if i % 5 in (0, 1) or i % 2 else 'assistant', 'content': f'第{i}条消息'}
+                    for i in range(history)]
+        results.append({
+            'history': history,
+            'merge_ms': timeit(lambda: statics.merge_adjacent_messages_with_same_role(messages), repeat) * 1000,
+        })
+    return results
+
+
+def bench_receive_drain(result_counts=(10, 100, 1000), repeat=20):
+    """Task.receive取出result_queue中的全部结果，只计算receive的时间"""
+    results = []
+    for count in result_counts:
+        task = infra.Task([{'name': 'service', 'server': 'mock'}])
+        elapsed = 0
+        for _ in range(repeat):
+            for i in range(count):
+                task.result_queue.put(SimpleNamespace(service='service', result_type='record', order=i,
+                                                      reply={'role': 'assistant', 'content': f'第{i}个结果'}))
+            start = time.perf_counter()
+            task.receive()
+            elapsed += time.perf_counter() - start
+        results.append({'results': count, 'drain_ms': elapsed / repeat * 1000})
+    return results
+
+
+STARTUP_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+sys.path.insert(0, {path!r})
+import infra, multi_talk, extraction, paradigm
+imported = time.perf_counter()
+# 界面可以响应之前需要创建的对象
+extraction.ResultValidator()
+info = extraction.EXTRACT_SERVICE
+infra.Service(info['name'], info['server'], info.get('model', ''))
+interactive = time.perf_counter()
+loaded = [name for name in ('openai', 'httpx', 'requests') if name in sys.modules]
+paradigm.warm_up(info['server'], background=False)
+warmed = time.perf_counter()
+print(json.dumps({{'import_ms': (imported - start) * 1000, 'interactive_ms': (interactive - start) * 1000,
+                  'warm_ms': (warmed - interactive) * 1000,
+                  'sdk_loaded': loaded}}))
+"""
+
+
+def bench_startup(repeat=5):
+    """
+    在新的解释器中测量冷启动：导入infra、multi_talk、extraction的耗时，到界面可以响应的耗时，
+    以及之后在后台导入SDK、创建客户端的耗时，取中位数
+    """
+    script = STARTUP_SCRIPT.format(path=os.path.dirname(os.path.abspath(__file__)))
+    # EXTRACT_SERVICE默认使用qwen，没有密钥时无法创建客户端
+    env = dict(os.environ)
+    env.setdefault('QWEN_API_KEY', 'benchmark')
+    runs = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, check=True, env=env)
+        runs.append(json.loads(output.stdout.strip().splitlines()[-1]))
+    result = {'modules': 'infra,multi_talk,extraction'}
+    for key in ('import_ms', 'interactive_ms', 'warm_ms'):
+        result[key] = statistics.median(run[key] for run in runs)
+    # 启动时已经导入的SDK，应该为空
+    result['eager_sdk'] = ','.join(runs[0]['sdk_loaded']) or '-'
+    return [result]
+
+
+BENCHMARKS = {
+    'related_context': bench_related_context,
+    'record_size': bench_record_size,
+    'merge_params': bench_merge_params,
+    'task_assign': bench_task_assign,
+    'talk_round': bench_talk_round,
+    'merge_adjacent': bench_merge_adjacent,
+    'receive_drain': bench_receive_drain,
+    'startup': bench_startup,
+}
+RESULTS_DIR = '.benchmarks'
+
+
+def current_commit():
+    """当前的commit和工作区是否有未提交的修改，不在git仓库中时返回unknown"""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'],
+                                    capture_output=True, text=True).stdout.strip())
+        return commit, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown', False
+
+
+def save_results(results, directory=RESULTS_DIR):
+    commit, dirty = current_commit()
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{commit[:12]}{'-dirty' if dirty else ''}.json")
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({
+            'commit': commit,
+            'dirty': dirty,
+            'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'python': platform.python_version(),
+            'results': results,
+        }, f, ensure_ascii=False, indent=1)
+    return path
+
+
+def load_results(commit, directory=RESULTS_DIR):
+    """读取之前保存的结果，commit可以是commit的前缀或保存的文件路径"""
+    if os.path.exists(commit):
+        path = commit
+    else:
+        matched = sorted(name for name in os.listdir(directory) if name.startswith(commit[:12]))
+        if not matched:
+            raise FileNotFoundError(f'没有找到{commit}的测试结果')
+        path = os.path.join(directory, matched[0])
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)['results']
+
+
+def compare(base, results):
+    """按相同的测试参数对比耗时，ratio大于1表示比base慢"""
+    for name, rows in results.items():
+        if name not in base:
+            continue
+        print(name)
+        for row in rows:
+            keys = {key: value for key, value in row.items() if not key.endswith(('_ms', 'bytes'))}
+            for base_row in base[name]:
+                if all(base_row.get(key) == value for key, value in keys.items()):
+                    ratios = [f'{key}: {base_row[key]:.4f} -> {value:.4f} ({value / base_row[key]:.2f}x)'
+                              for key, value in row.items() if key in base_row and key not in keys and base_row[key]]
+                    print('    ' + ', '.join(f'{key}: {value}' for key, value in keys.items()) + ' | ' + ', '.join(ratios))
+                    break
+
+
+def report(name, results):
+    print(name)
+    for result in results:
+        print('    ' + ', '.join(f'{key}: {value:.4f}' if isinstance(value, float) else f'{key}: {value}'
+                                  for key, value in result.items()))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='编排层自身开销的性能测试')
+    parser.add_argument('names', nargs='*', help=f"要运行的测试，默认全部：{', '.join(BENCHMARKS)}")
+    parser.add_argument('--save', action='store_true', help=f'把结果保存到{RESULTS_DIR}/<commit>.json')
+    parser.add_argument('--compare', help='和之前保存的某个commit的结果对比')
+    args = parser.parse_args(argv)
+
+    results = {}
+    for name in args.names or BENCHMARKS:
+        results[name] = BENCHMARKS[name]()
+        report(name, results[name])
+    if args.save:
+        print(f'saved: {save_results(results)}')
+    if args.compare:
+        compare(load_results(args.compare), results)
+    return results
+
+
+if __name__ == '__main__':
+    main()
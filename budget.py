@@ -0,0 +1,217 @@
+# 上下文token预算：估计每条消息的token数，超出模型窗口时按策略裁剪或摘要历史消息
+import functools
+import paradigm
+
+# tiktoken在第一次计算token数时才加载，见get_encoding
+_encoding = None
+_encoding_loaded = False
+
+# 没有在MODEL_WINDOW中的模型使用的窗口大小
+DEFAULT_WINDOW = 8192
+# 每条消息除内容外的格式开销
+MESSAGE_OVERHEAD = 4
+
+# 摘要消息的开头，再次摘要时之前的摘要会一起被概括
+SUMMARY_PREFIX = '之前对话的摘要：'
+
+SUMMARY_PROMPT = """
+请把下面的对话概括成一段摘要，保留人物、事实、结论和尚未解决的问题，不要添加对话中没有的内容。
+"""
+
+# 生成摘要时为summarizer的回复预留的token数
+SUMMARY_RESERVE = 1024
+
+
+def get_encoding():
+    global _encoding, _encoding_loaded
+    if not _encoding_loaded:
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding('cl100k_base')
+        except Exception:
+            # 没有安装tiktoken时使用按字符估计的方法
+            _encoding = None
+        _encoding_loaded = True
+    return _encoding
+
+
+@functools.lru_cache(maxsize=65536)
+def count_text(text):
+    """估计一段文字的token数，同样的内容只计算一次"""
+    encoding = get_encoding()
+    if encoding:
+        return len(encoding.encode(text))
+    # 中日韩文字大约一个字一个token，其余字符大约四个一个token
+    cjk = sum(1 for char in text if '\u2e80' <= char <= '\u9fff' or '\uf900' <= char <= '\ufaff')
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def count_message(message):
+    content = message.get('content')
+    tokens = MESSAGE_OVERHEAD
+    if isinstance(content, str):
+        tokens += count_text(content)
+    elif isinstance(content, list):
+        for part in content:
+            if isinstance(part, dict) and isinstance(part.get('text'), str):
+                tokens += count_text(part['text'])
+    for tool_call in message.get('tool_calls') or []:
+        function = tool_call.get('function', {}) if isinstance(tool_call, dict) else {}
+        tokens += count_text(function.get('name') or '') + count_text(function.get('arguments') or '')
+    return tokens
+
+
+def count_messages(messages):
+    return sum(count_message(message) for message in messages)
+
+
+class ContextBudget:
+    """
+    policy可以是：
+        sliding_window：从最早的消息开始丢弃，system消息也会被丢弃
+        pin_system：保留开头的system消息，从最早的其他消息开始丢弃
+        summarize：保留system消息和最近keep_recent条消息，之前的消息由summarizer概括成一条摘要
+    reserve是为模型回复预留的token数
+    summarizer是用来生成摘要的Service，一般使用更便宜的模型
+    """
+    def __init__(self, model='', policy='pin_system', window=None, reserve=1024, summarizer=None, keep_recent=6):
+        self.window = window or paradigm.MODEL_WINDOW.get(model, DEFAULT_WINDOW)
+        self.limit = self.window - reserve
+        self.policy = policy
+        self.summarizer = summarizer
+        self.keep_recent = keep_recent
+        # 滚动摘要：最近一次的摘要，以及它概括了历史开头的多少条消息（和首尾消息的指纹，用来确认历史没有变化）
+        # 之后只把新淘汰的消息和这份摘要一起再概括，不重新概括整段历史
+        self.summary = None
+        self.covered = 0
+        self.covered_marks = None
+        self.trimmed = 0
+
+    def fit(self, messages):
+        """返回不超过预算的消息列表，没有超出时原样返回；最后一条消息总会保留，必要时截断"""
+        if count_messages(messages) <= self.limit:
+            return messages
+
+        pinned = []
+        rest = list(messages)
+        if self.policy != 'sliding_window':
+            while rest and rest[0].get('role') == 'system':
+                pinned.append(rest.pop(0))
+
+        if self.policy == 'summarize' and self.summarizer and len(rest) > self.keep_recent:
+            previous = [message for message in pinned if is_summary(message)]
+            pinned = [message for message in pinned if not is_summary(message)]
+            old = rest[:-self.keep_recent]
+            rest = rest[-self.keep_recent:]
+            pinned += self.roll_summary(previous, old)
+
+        budget = self.limit - count_messages(pinned)
+        kept = []
+        for message in reversed(rest):
+            tokens = count_message(message)
+            if tokens > budget:
+                break
+            budget -= tokens
+            kept.append(message)
+        kept.reverse()
+        if not kept and rest:
+            # 最新的一条消息（一般是这一轮的问题）不能丢，单独超出预算时截断到剩余的预算
+            kept = [truncate_message(rest[-1], budget)]
+        # 不能留下找不到对应tool_call的tool消息
+        while len(kept) > 1 and kept[0].get('role') == 'tool':
+            kept.pop(0)
+        self.trimmed += len(rest) - len(kept)
+        return pinned + kept
+
+    def roll_summary(self, previous, old):
+        """
+        返回概括了old（以及之前的摘要）的摘要消息列表
+        previous是消息中已经带着的摘要（Talker会用fit的结果替换context），这时old都是新淘汰的消息
+        否则old的开头和上次概括的消息相同时，只概括之后新增的部分
+        """
+        if previous:
+            base, new = previous, old
+        elif self.summary and self.covered <= len(old) and self.marks(old[:self.covered]) == self.covered_marks:
+            base, new = [self.summary], old[self.covered:]
+        else:
+            base, new = [], old
+        if not new:
+            return base
+        summary = self.summarize(base + new)
+        if not summary:
+            # 摘要失败时保留之前的摘要，新淘汰的消息按预算丢弃
+            return base
+        self.summary = summary
+        self.covered = len(old)
+        self.covered_marks = self.marks(old)
+        return [summary]
+
+    @staticmethod
+    def marks(messages):
+        if not messages:
+            return None
+        return len(messages), fingerprint(messages[0]), fingerprint(messages[-1])
+
+    def summary_limit(self):
+        """一次交给summarizer的对话的token上限：summarizer的窗口减去提示词和回复预留"""
+        model = getattr(self.summarizer.request, 'model', '')
+        window = paradigm.MODEL_WINDOW.get(model, DEFAULT_WINDOW)
+        return max(window - count_text(SUMMARY_PROMPT) - SUMMARY_RESERVE, SUMMARY_RESERVE)
+
+    def summarize(self, messages):
+        """概括messages，超出summarizer窗口时分段，每段连同上一段的摘要一起概括"""
+        limit = self.summary_limit()
+        lines = []
+        for message in messages:
+            if isinstance(message.get('content'), str) and message.get('role') != 'tool':
+                line = f"{message['role']}：{message['content']}"
+                # 单条超出上限的消息截断，每个字符至少一个token的估计偏保守
+                lines.append(line if count_text(line) <= limit else line[:limit])
+
+        summary = None
+        while lines:
+            chunk = [summary] if summary else []
+            tokens = sum(count_text(line) for line in chunk)
+            # 每段至少放入一条新的消息
+            taken = 0
+            while lines and (not taken or tokens + count_text(lines[0]) <= limit):
+                tokens += count_text(lines[0])
+                chunk.append(lines.pop(0))
+                taken += 1
+            result = self.summarizer.respond([
+                {'role': 'system', 'content': SUMMARY_PROMPT},
+                {'role': 'user', 'content': '\n'.join(chunk)},
+            ], silent=True)
+            if not result:
+                return None
+            summary = f"{SUMMARY_PREFIX}{result['show_msg']}"
+        if summary is None:
+            return None
+        return {'role': 'system', 'content': summary}
+
+
+def truncate_text(text, tokens):
+    """保留text末尾不超过tokens个token的部分"""
+    if tokens <= 0:
+        return ''
+    encoding = get_encoding()
+    if encoding:
+        return encoding.decode(encoding.encode(text)[-tokens:])
+    # 按字符估计时每个字符最多算一个token，保留末尾tokens个字符不会超出
+    return text[-tokens:]
+
+
+def truncate_message(message, tokens):
+    """把消息的文字内容截断到tokens以内（包括格式开销），保留末尾；不是文字的内容原样返回"""
+    content = message.get('content')
+    if count_message(message) <= tokens or not isinstance(content, str):
+        return message
+    return dict(message, content=truncate_text(content, tokens - (count_message(message) - count_text(content))))
+
+
+def is_summary(message):
+    return message.get('role') == 'system' and str(message.get('content', '')).startswith(SUMMARY_PREFIX)
+
+
+def fingerprint(message):
+    return message.get('role'), str(message.get('content')), message.get('tool_call_id')
@@ -0,0 +1,204 @@
+# 请求结果缓存：内存LRU + SQLite磁盘两级，key是请求参数的稳定hash
+# SingleFlight合并同时进行的相同请求，只向服务端发一次
+import asyncio
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+# 不影响返回内容的参数，不参与计算key
+IGNORED_PARAMS = ('stream', 'stream_options')
+
+
+def request_key(params, server=None):
+    """根据server、model、messages、tools和采样参数计算稳定的hash，不同服务商的同名模型不共用"""
+    payload = {key: value for key, value in params.items() if key not in IGNORED_PARAMS}
+    if server is not None:
+        payload['server'] = server
+    text = json.dumps(payload, sort_keys=True, ensure_ascii=False, separators=(',', ':'), default=str)
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    """
+    path为空时只使用内存缓存
+    ttl是缓存的有效秒数，为None时不过期
+    capacity和disk_capacity分别是内存和磁盘中最多保存的条数，超出后淘汰最久未使用的
+    cache_sampling为False时只缓存明确传入temperature=0的请求，没有传入temperature时服务商使用默认的采样温度，同样不缓存
+    """
+    def __init__(self, path=None, capacity=256, disk_capacity=100000, ttl=None, cache_sampling=False):
+        self.capacity = capacity
+        self.disk_capacity = disk_capacity
+        self.ttl = ttl
+        self.cache_sampling = cache_sampling
+
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._writes = 0
+
+        self.db = None
+        if path:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute('CREATE TABLE IF NOT EXISTS responses '
+                            '(key TEXT PRIMARY KEY, value TEXT, created REAL, accessed REAL)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+            self.db.commit()
+
+    def cacheable(self, params):
+        temperature = params.get('temperature')
+        return self.cache_sampling or temperature == 0
+
+    def _expired(self, created, now):
+        return self.ttl is not None and now - created > self.ttl
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            item = self.memory.get(key)
+            if item is not None:
+                created, value = item
+                if not self._expired(created, now):
+                    self.memory.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self.memory[key]
+
+            if self.db is not None:
+                row = self.db.execute('SELECT value, created FROM responses WHERE key = ?', (key,)).fetchone()
+                if row and not self._expired(row[1], now):
+                    self.db.execute('UPDATE responses SET accessed = ? WHERE key = ?', (now, key))
+                    self.db.commit()
+                    self._remember(key, row[1], row[0])
+                    self.hits += 1
+                    self.disk_hits += 1
+                    return row[0]
+
+            self.misses += 1
+            return None
+
+    def set(self, key, value):
+        now = time.time()
+        with self.lock:
+            self._remember(key, now, value)
+            if self.db is not None:
+                self.db.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)', (key, value, now, now))
+                self._writes += 1
+                # 每写入一批再检查一次磁盘容量，避免每次写入都扫描整张表
+                if self._writes % 64 == 0:
+                    self._evict_disk(now)
+                self.db.commit()
+
+    def _remember(self, key, created, value):
+        self.memory[key] = (created, value)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.capacity:
+            self.memory.popitem(last=False)
+
+    def _evict_disk(self, now):
+        if self.ttl is not None:
+            self.db.execute('DELETE FROM responses WHERE created < ?', (now - self.ttl,))
+        self.db.execute('DELETE FROM responses WHERE key IN '
+                        '(SELECT key FROM responses ORDER BY accessed DESC LIMIT -1 OFFSET ?)',
+                        (self.disk_capacity,))
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+            if self.db is not None:
+                self.db.execute('DELETE FROM responses')
+                self.db.commit()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0,
+            'memory_items': len(self.memory),
+        }
+
+
+class SingleFlight:
+    """
+    相同key的请求同时进行时，只有第一个（leader）真正执行，其余的等待并得到同一个结果或异常
+    同步和异步调用分开合并，避免在事件循环线程中同步等待同一个循环里的请求
+    """
+    def __init__(self):
+        self.calls = {}
+        self.lock = threading.Lock()
+        self.leaders = 0
+        self.coalesced = 0
+
+    def _join(self, key):
+        """返回(future, 是否leader)"""
+        with self.lock:
+            call = self.calls.get(key)
+            if call is not None:
+                self.coalesced += 1
+                return call, False
+            call = Future()
+            self.calls[key] = call
+            self.leaders += 1
+            return call, True
+
+    def _finish(self, key):
+        with self.lock:
+            self.calls.pop(key, None)
+
+    def do(self, key, func, timeout=None):
+        """返回(结果, 是否合并到了其他请求)；timeout是等待其他请求的秒数，超时抛出TimeoutError"""
+        call, leader = self._join(('sync', key))
+        if not leader:
+            try:
+                return call.result(timeout), True
+            except TimeoutError:
+                raise TimeoutError(f'等待合并的请求超过{timeout}秒') from None
+        try:
+            result = func()
+        except BaseException as e:
+            call.set_exception(e)
+            raise
+        else:
+            call.set_result(result)
+            return result, False
+        finally:
+            self._finish(('sync', key))
+
+    async def ado(self, key, func, timeout=None):
+        """do的异步版本，func返回coroutine，同一个事件循环中的相同请求会被合并"""
+        loop_key = (id(asyncio.get_running_loop()), key)
+        call, leader = self._join(loop_key)
+        if not leader:
+            # shield避免等待超时时取消leader的结果
+            try:
+                return await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(call)), timeout), True
+            except asyncio.TimeoutError:
+                raise TimeoutError(f'等待合并的请求超过{timeout}秒') from None
+        try:
+            result = await func()
+        except BaseException as e:
+            call.set_exception(e)
+            raise
+        else:
+            call.set_result(result)
+            return result, False
+        finally:
+            self._finish(loop_key)
+
+    def stats(self):
+        with self.lock:
+            in_flight = len(self.calls)
+        total = self.leaders + self.coalesced
+        return {
+            'leaders': self.leaders,
+            'coalesced': self.coalesced,
+            'coalesce_rate': self.coalesced / total if total else 0,
+            'in_flight': in_flight,
+        }
@@ -0,0 +1,478 @@
+# 从家长与老师的对话中提取拒学信息的prompt及结果处理
+import json
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+import infra
+
+EXTRACT_SERVICE = {'name': 'qwen', 'server': 'qwen', 'model': 'qwen-plus'}
+
+# 需要提取的各项信息，key与返回json的key一致
+SECTIONS = {
+    '儿童基本情况': '儿童基本情况，包括姓名、性别、年龄、年级、是否独生子女、身体健康情况，使用字典格式输出。',
+    '父母家庭情况': '父母家庭情况，包括父亲职业、父亲学历、母亲职业、母亲学历、父母婚姻状况、家庭经济情况，使用字典格式输出。',
+    '兄弟姐妹': '兄弟姐妹的情况，使用列表格式输出，列表中的每个项目是一个字典，包括 关系、年龄 两个key。如果是独生子女，不需要提取这一项。',
+    '儿童养育情况': '儿童养育情况：包括出生方式、婴儿期喂养方式、幼儿时期的抚养情况。请根据对话内容，进行一定的概括。使用字典格式输出。',
+    '儿童成长情况': '儿童成长情况；幼儿园、小学、初中、高中四个时期儿童的个性特点、学业情况和社交情况。请根据对话内容，进行一定的概括。使用二级字典格式输出，时期是第一级的key。如果孩儿童还未达到某个时期，不需要出现该时期的key。',
+    '身心特点': '身心特点：包括认知特点、情绪特点、社会交往特点、兴趣爱好、性别与文化议题。请根据对话内容，进行一定的概括。使用字典格式输出，如果没有提到某项内容，不需要出现对应的key。',
+    '拒学发展的情况': '拒学发展的情况：孩子的拒学情况是如何发展变化的，请使用列表输出。列表每个项目是对一个事件的拒学情况概括，如"四年级，学习跟不上，经常早上不愿意起床"，不同时间的表现属于不同项目。',
+    '当前拒学状态': '当前拒学状态：当前孩子是否能去上学、在学校或家中的学习表现，用几句话概括。',
+    '近期状态': '近期状态：当前孩子的饮食、睡眠、购物、运动、社交、生活自理、情绪、自杀自残的情况等。使用字典格式输出，key是某个方面，value是这个方面对应情况的描述。如果某个方面没有提到，则不需要出现对应的key。',
+    '重大事件/压力事件': '重大事件/压力事件：家长提到的一些重要的事件。使用列表输出，每个项目是对一个事件的完整描述，需要提到事件中的具体内容和重要细节。',
+    '孩子的态度': '孩子的态度：孩子自身对学习的态度。用几句话概括。',
+    '家长的态度': '家长的态度：家长对于孩子不上学的态度。用几句话概括。',
+}
+
+# 修复被截断的json时，最多尝试的截断位置数
+REPAIR_ATTEMPTS = 64
+TRAILING_COMMA = re.compile(r',\s*([}\]])')
+
+EXTRACT_PROMPT = """
+你会收到一段用户和老师的对话，用户在对话中，会描述一个孩子的情况，你需要提取以下信息：
+""" + ''.join(f"- {description}\n" for description in SECTIONS.values()) + """请注意孩子的性别，并使用正确的代词。
+请使用json组织提取到的信息。仅返回json，不要有其他任何内容。
+"""
+
+
+def build_messages(dialog):
+    """把一段对话组装成提取信息的messages"""
+    return [
+        {'role': 'system', 'content': EXTRACT_PROMPT},
+        {'role': 'user', 'content': f"对话内容是:\n{dialog}\n"},
+    ]
+
+
+def strip_fence(text):
+    """去掉模型返回结果中可能的```json和```标记"""
+    text = text.strip()
+    if text.startswith("```json"):
+        text = text[7:]
+    elif text.startswith("```"):
+        text = text[3:]
+    if text.endswith("```"):
+        text = text[:-3]
+    return text.strip()
+
+
+def repair_json(text):
+    """
+    解析模型返回的json，能修复代码块标记、前后多余的文字、多余的逗号和被截断的结尾
+    返回(data, repaired)，repaired表示是否经过了修复，无法修复时抛出json.JSONDecodeError
+    """
+    text = strip_fence(text)
+    try:
+        return json.loads(text), False
+    except json.JSONDecodeError as e:
+        error = e
+
+    begin = text.find('{')
+    if begin < 0:
+        raise error
+    text = TRAILING_COMMA.sub(r'\1', text[begin:])
+    try:
+        return json.JSONDecoder().raw_decode(text)[0], True
+    except json.JSONDecodeError:
+        pass
+
+    # 被截断时，找到最后几个完整值结束的位置，补上没有闭合的括号
+    candidates = []
+    stack = []
+    in_string = False
+    escaped = False
+    for i, char in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char == '"':
+                in_string = False
+                candidates.append((i + 1, ''.join(stack)))
+        elif char == '"':
+            in_string = True
+        elif char in '{[':
+            stack.append('}' if char == '{' else ']')
+        elif char in '}]':
+            if stack:
+                stack.pop()
+            candidates.append((i + 1, ''.join(stack)))
+        elif char == ',':
+            candidates.append((i, ''.join(stack)))
+        elif char.isdigit() or char in 'el':
+            # 数字、true、false、null的结尾
+            candidates.append((i + 1, ''.join(stack)))
+    for end, closers in reversed(candidates[-REPAIR_ATTEMPTS:]):
+        try:
+            return json.loads(text[:end] + closers[::-1]), True
+        except json.JSONDecodeError:
+            continue
+    raise error
+
+
+def parse_result(text):
+    """解析模型返回的json，会尝试修复格式错误，无法修复时抛出json.JSONDecodeError"""
+    return repair_json(text)[0]
+
+
+# 长对话分段提取：按说话轮次切分，每段单独提取后再合并
+MAX_CHUNK_CHARS = 6000
+OVERLAP_TURNS = 2
+# 一轮对话的开头，如"老师："、"家长:"
+TURN_PATTERN = re.compile(r'^\s*[^\s：:]{1,10}[：:]')
+# 模型对没有提到的内容常用的写法，合并时视为空
+EMPTY_VALUES = ('', '无', '未提及', '未知', '不详')
+
+# 放在对话后面而不是system prompt中，每一段的system prompt完全相同，可以命中服务端的上下文缓存
+CHUNK_PROMPT = """
+这段对话比较长，被分成了{total}段，上面是第{index}段，开头可能和上一段有少量重复。
+只提取这一段中提到的信息，没有提到的项目不需要出现在json中。
+"""
+
+
+def split_turns(dialog):
+    """把对话按说话人切分成轮次，不以说话人开头的行属于上一轮"""
+    turns = []
+    for line in dialog.splitlines():
+        if not line.strip():
+            continue
+        if turns and not TURN_PATTERN.match(line):
+            turns[-1] += '\n' + line
+        else:
+            turns.append(line)
+    return turns
+
+
+def split_dialog(dialog, max_chars=MAX_CHUNK_CHARS, overlap=OVERLAP_TURNS):
+    """
+    按轮次把对话切分成不超过max_chars的几段，不会从一轮对话的中间切开
+    每段开头重复上一段最后overlap轮，避免跨段的问答丢失上下文
+    """
+    turns = split_turns(dialog)
+    chunks = []
+    current = []
+    size = 0
+    for turn in turns:
+        if current and size + len(turn) > max_chars:
+            chunks.append('\n'.join(current))
+            current = current[-overlap:] if overlap else []
+            # 重复的部分本身已经太长时不再重复，保证每段都有新内容
+            if sum(len(item) for item in current) + len(turn) > max_chars:
+                current = []
+            size = sum(len(item) + 1 for item in current)
+        current.append(turn)
+        size += len(turn) + 1
+    if current:
+        chunks.append('\n'.join(current))
+    return chunks
+
+
+def build_chunk_messages(chunk, index, total):
+    messages = build_messages(chunk)
+    messages[1]['content'] += CHUNK_PROMPT.format(index=index + 1, total=total)
+    return messages
+
+
+def is_empty(value):
+    if isinstance(value, str):
+        return value.strip() in EMPTY_VALUES
+    return value is None or value == [] or value == {}
+
+
+def _dump(value):
+    return json.dumps(value, sort_keys=True, ensure_ascii=False)
+
+
+def merge_lists(old, new):
+    """
+    合并两段的列表，保持先后顺序：拒学发展的情况等时间线按对话中出现的顺序排列
+    重复的项目只保留一个，字典项目没有冲突的字段时视为同一个（如同一个兄弟姐妹）并合并字段
+    """
+    merged = list(old)
+    seen = {_dump(item) for item in merged}
+    for item in new:
+        if is_empty(item) or _dump(item) in seen:
+            continue
+        if isinstance(item, dict):
+            for i, existing in enumerate(merged):
+                if isinstance(existing, dict):
+                    common = [key for key in item if key in existing
+                              and not is_empty(item[key]) and not is_empty(existing[key])]
+                    if common and all(item[key] == existing[key] for key in common):
+                        merged[i] = merge_values(existing, item)
+                        break
+            else:
+                merged.append(item)
+        else:
+            merged.append(item)
+        seen.add(_dump(item))
+    return merged
+
+
+def merge_values(old, new):
+    """按类型合并同一项目在两段中的结果，new来自更靠后的一段"""
+    if is_empty(old):
+        return new
+    if is_empty(new):
+        return old
+    if isinstance(old, dict) and isinstance(new, dict):
+        merged = dict(old)
+        for key, value in new.items():
+            merged[key] = merge_values(old.get(key), value)
+        return merged
+    if isinstance(old, list) or isinstance(new, list):
+        return merge_lists(old if isinstance(old, list) else [old], new if isinstance(new, list) else [new])
+    if isinstance(old, str) and isinstance(new, str):
+        if new in old:
+            return old
+        if old in new:
+            return new
+        return f'{old}；{new}'
+    return new
+
+
+def merge_results(results):
+    """按对话顺序合并每一段的提取结果，解析失败的段（None）跳过"""
+    merged = {}
+    for result in results:
+        if isinstance(result, dict):
+            merged = merge_values(merged, result)
+    return merged
+
+
+def extract_chunked(dialog, service_info=None, concurrency=4, max_chars=MAX_CHUNK_CHARS, overlap=OVERLAP_TURNS):
+    """
+    分段并行提取一段长对话，耗时取决于段数/concurrency，而不是对话长度
+    返回result（合并后的结果）、chunks（段数）、failed（失败的段序号）和elapsed
+    """
+    start = time.time()
+    service_info = (service_info or EXTRACT_SERVICE).copy()
+    chunks = split_dialog(dialog, max_chars, overlap)
+
+    def extract(index):
+        service = infra.Service(f"{service_info['name']}_{index}", service_info['server'], service_info.get('model', ''))
+        result = service.respond(build_chunk_messages(chunks[index], index, len(chunks)), silent=True)
+        if not result:
+            raise RuntimeError('模型没有返回结果')
+        return parse_result(result['show_msg'])
+
+    results = []
+    failed = []
+    with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(chunks)))) as executor:
+        futures = [executor.submit(extract, index) for index in range(len(chunks))]
+        for index, future in enumerate(futures):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                print(f'第{index + 1}段提取失败：{type(e).__name__}: {e}')
+                results.append(None)
+                failed.append(index)
+
+    return SimpleNamespace(result=merge_results(results), chunks=len(chunks), failed=failed,
+                           elapsed=time.time() - start)
+
+
+# 分项提取：每一项单独请求并行发送，总耗时取决于最慢的一项而不是整个json的长度
+# shared_prefix为True时各项共用列出全部要求的SECTION_PROMPT，同一段对话的请求只有最后一句不同，前缀可以命中服务端的上下文缓存
+# 为False时每项只带自己的要求（SECTION_ITEM_PROMPT），prompt更短，适合没有上下文缓存的服务商
+SECTION_PROMPT = """
+你会收到一段用户和老师的对话，用户在对话中，会描述一个孩子的情况。对话后面会指定需要提取的一项信息，各项信息的要求如下：
+""" + ''.join(f"- {description}\n" for description in SECTIONS.values()) + """请注意孩子的性别，并使用正确的代词。
+请使用json组织提取到的信息，json中只有指定的那一项一个key。仅返回json，不要有其他任何内容。
+"""
+
+
+SECTION_ITEM_PROMPT = """
+你会收到一段用户和老师的对话，用户在对话中，会描述一个孩子的情况。请提取{description}
+请注意孩子的性别，并使用正确的代词。
+请使用json组织提取到的信息，json中只有"{key}"一个key。仅返回json，不要有其他任何内容。
+"""
+
+
+SECTION_PREFIX = [{'role': 'system', 'content': SECTION_PROMPT}]
+
+
+def build_section_messages(dialog, key, shared_prefix=True):
+    """shared_prefix为True时不包含SECTION_PREFIX，由Service.set_prefix在发送时加上"""
+    if shared_prefix:
+        return [{'role': 'user', 'content': f"对话内容是:\n{dialog}\n需要提取的信息：{key}"}]
+    return [
+        {'role': 'system', 'content': SECTION_ITEM_PROMPT.format(description=SECTIONS[key], key=key)},
+        {'role': 'user', 'content': f"对话内容是:\n{dialog}"},
+    ]
+
+
+def usage_of(services, start):
+    """汇总几个service的耗时、token用量和费用，用于比较不同的提取方式"""
+    fees = [service.request.fee() for service in services]
+    fees = [fee for fee in fees if fee is not None]
+    return SimpleNamespace(
+        elapsed=time.time() - start,
+        prompt_tokens=sum(service.request.prompt_tokens for service in services),
+        completion_tokens=sum(service.request.completion_tokens for service in services),
+        cached_tokens=sum(service.request.cached_tokens for service in services),
+        fee=sum(fees) if fees else None,
+    )
+
+
+def extract_single(dialog, service_info=None):
+    """一个prompt提取全部信息，返回result、raw、failed和用量"""
+    start = time.time()
+    service_info = service_info or EXTRACT_SERVICE
+    service = infra.Service(service_info['name'], service_info['server'], service_info.get('model', ''))
+    result = service.respond(build_messages(dialog), silent=True)
+    raw = result['show_msg'] if result else ''
+    try:
+        data = parse_result(raw)
+    except json.JSONDecodeError:
+        data = None
+    stats = usage_of([service], start)
+    stats.result = data
+    stats.raw = raw
+    stats.failed = [] if isinstance(data, dict) else list(SECTIONS)
+    return stats
+
+
+def extract_sections(dialog, service_info=None, section_services=None, sections=None, shared_prefix=True):
+    """
+    每一项信息单独请求，通过Task.abs_assign并行发送，结果按SECTIONS的顺序组装成和extract_single相同的json
+    section_services可以为某几项指定更便宜或更快的模型，如{'孩子的态度': {'name': 'turbo', 'server': 'qwen', 'model': 'qwen-turbo'}}
+    shared_prefix见SECTION_PROMPT
+    返回result、failed（没有得到结果的项）和用量
+    """
+    start = time.time()
+    service_info = service_info or EXTRACT_SERVICE
+    section_services = section_services or {}
+    sections = sections or list(SECTIONS)
+
+    services = []
+    assign_list = []
+    for i, key in enumerate(sections):
+        info = section_services.get(key, service_info)
+        services.append({'name': f'section_{i}', 'server': info['server'], 'model': info.get('model', '')})
+        assign_list.append({'receiver': f'section_{i}', 'messages': build_section_messages(dialog, key, shared_prefix),
+                            'silent': True})
+    task = infra.Task(services)
+    if shared_prefix:
+        for service in task.services:
+            service.set_prefix(SECTION_PREFIX)
+    report = task.abs_assign(assign_list) or []
+
+    replies = {item['service']: item['reply'] for item in report}
+    result = {}
+    for i, key in enumerate(sections):
+        reply = replies.get(f'section_{i}')
+        if not reply or not reply.get('content'):
+            continue
+        try:
+            data = parse_result(reply['content'])
+        except json.JSONDecodeError:
+            continue
+        result[key] = data[key] if isinstance(data, dict) and key in data else data
+
+    stats = usage_of(task.services, start)
+    stats.result = result
+    stats.failed = [key for key in sections if key not in result]
+    return stats
+
+
+def compare_modes(dialog, service_info=None, section_services=None):
+    """
+    用同一段对话分别运行一次性提取、共用前缀的分项提取和各项独立小prompt的分项提取，打印耗时和费用
+    共用前缀的prompt_tokens更多，是否更便宜取决于cached_tokens的比例和服务商的缓存价格
+    """
+    single = extract_single(dialog, service_info)
+    sections = extract_sections(dialog, service_info, section_services)
+    small = extract_sections(dialog, service_info, section_services, shared_prefix=False)
+    for name, stats in (('single', single), ('sections', sections), ('sections_small', small)):
+        fee = f'{stats.fee:.4f}' if stats.fee is not None else '-'
+        print(f'{name}: elapsed {stats.elapsed:.2f}s, prompt_tokens {stats.prompt_tokens}, '
+              f'completion_tokens {stats.completion_tokens}, cached_tokens {stats.cached_tokens}, fee {fee}, failed {len(stats.failed)}')
+    return single, sections, small
+
+
+# 每一项的json类型，用于校验一次性提取的结果
+SCHEMA = {
+    '儿童基本情况': dict,
+    '父母家庭情况': dict,
+    '兄弟姐妹': list,
+    '儿童养育情况': dict,
+    '儿童成长情况': dict,
+    '身心特点': dict,
+    '拒学发展的情况': list,
+    '当前拒学状态': str,
+    '近期状态': dict,
+    '重大事件/压力事件': list,
+    '孩子的态度': str,
+    '家长的态度': str,
+}
+# 可以不出现的项，如独生子女没有兄弟姐妹
+OPTIONAL_SECTIONS = ('兄弟姐妹',)
+
+
+def validate(data):
+    """返回缺失或类型不对的项，为空表示结果完整"""
+    if not isinstance(data, dict):
+        return list(SCHEMA)
+    invalid = []
+    for key, value_type in SCHEMA.items():
+        if key not in data:
+            if key not in OPTIONAL_SECTIONS:
+                invalid.append(key)
+        elif not is_empty(data[key]) and not isinstance(data[key], value_type):
+            invalid.append(key)
+    return invalid
+
+
+class ResultValidator:
+    """
+    校验一次性提取的结果：先尝试修复json，仍然缺失或格式不对的项单独重新请求，不重新发送整个prompt
+    记录修复和重新请求的比例
+    """
+    def __init__(self, service_info=None, reask=True):
+        self.service_info = service_info
+        self.reask = reask
+        self.checked = 0
+        self.repaired = 0
+        self.reasked = 0
+        self.reasked_sections = 0
+        self.failed = 0
+        self.lock = threading.Lock()
+
+    def check(self, raw, dialog, service_info=None):
+        """返回result（无法得到结果时为None）、repaired、reasked和failed（最终仍然缺失的项）"""
+        try:
+            data, repaired = repair_json(raw)
+        except json.JSONDecodeError:
+            data, repaired = None, False
+        if not isinstance(data, dict):
+            data = {}
+        invalid = validate(data)
+
+        reasked = []
+        if invalid and self.reask:
+            stats = extract_sections(dialog, service_info or self.service_info, sections=invalid)
+            data.update(stats.result)
+            reasked = invalid
+            invalid = [key for key in validate(data) if key in invalid]
+
+        with self.lock:
+            self.checked += 1
+            self.repaired += repaired
+            self.reasked += bool(reasked)
+            self.reasked_sections += len(reasked)
+            self.failed += bool(invalid)
+        # 按SCHEMA的顺序排列，方便显示
+        result = {key: data[key] for key in SCHEMA if key in data}
+        result.update({key: value for key, value in data.items() if key not in result})
+        return SimpleNamespace(result=result or None, repaired=repaired, reasked=reasked, failed=invalid)
+
+    def stats(self):
+        return {
+            'checked': self.checked,
+            'repair_rate': self.repaired / self.checked if self.checked else 0,
+            'reask_rate': self.reasked / self.checked if self.checked else 0,
+            'reasked_sections': self.reasked_sections,
+            'failed': self.failed,
+        }
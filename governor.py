@@ -0,0 +1,149 @@
+# 按服务商账号限制请求速率：每分钟请求数、每分钟token数和同时进行的请求数
+# 同一个账号（paradigm.limiter_key，base_url和api key相同）的所有Request、Service共用一个限流器，超出限制时排队等待而不是报错
+import asyncio
+import threading
+import time
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def estimate_tokens(params):
+    """粗略估计一次请求消耗的token数：中文大约一个字一个token，英文大约四个字符一个token"""
+    chars = 0
+    for message in params.get('messages', []):
+        content = message.get('content')
+        if isinstance(content, str):
+            chars += len(content)
+        elif isinstance(content, list):
+            for part in content:
+                if isinstance(part, dict) and isinstance(part.get('text'), str):
+                    chars += len(part['text'])
+    return chars // 2 + (params.get('max_tokens') or 0)
+
+
+class RateLimiter:
+    """
+    rpm、tpm使用令牌桶，concurrency限制同时进行的请求数，为0时不限制
+    acquire和release需要成对调用
+    """
+    def __init__(self, rpm=0, tpm=0, concurrency=0):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.concurrency = concurrency
+
+        self.request_tokens = rpm
+        self.token_tokens = tpm
+        self.running = 0
+        self.updated = time.monotonic()
+        self.condition = threading.Condition()
+
+        self.waited = 0
+        self.queued = 0
+
+    def _refill(self, now):
+        elapsed = now - self.updated
+        self.updated = now
+        if self.rpm:
+            self.request_tokens = min(self.rpm, self.request_tokens + elapsed * self.rpm / 60)
+        if self.tpm:
+            self.token_tokens = min(self.tpm, self.token_tokens + elapsed * self.tpm / 60)
+
+    def _try_acquire(self, tokens):
+        """能发出请求时占用额度并返回0，否则返回需要等待的秒数（并发已满时返回None）"""
+        self._refill(time.monotonic())
+        if self.concurrency and self.running >= self.concurrency:
+            return None
+        wait = 0
+        if self.rpm and self.request_tokens < 1:
+            wait = max(wait, (1 - self.request_tokens) * 60 / self.rpm)
+        # 一次请求超过整个tpm时，只要桶满就放行，避免永远等待
+        tokens = min(tokens, self.tpm)
+        if self.tpm and self.token_tokens < tokens:
+            wait = max(wait, (tokens - self.token_tokens) * 60 / self.tpm)
+        if wait:
+            return wait
+        if self.rpm:
+            self.request_tokens -= 1
+        if self.tpm:
+            self.token_tokens -= tokens
+        self.running += 1
+        return 0
+
+    def acquire(self, tokens=0):
+        start = time.monotonic()
+        with self.condition:
+            wait = self._try_acquire(tokens)
+            if wait != 0:
+                self.queued += 1
+            while wait != 0:
+                self.condition.wait(wait)
+                wait = self._try_acquire(tokens)
+        self.waited += time.monotonic() - start
+
+    async def aacquire(self, tokens=0):
+        start = time.monotonic()
+        while True:
+            with self.condition:
+                wait = self._try_acquire(tokens)
+            if wait == 0:
+                break
+            await asyncio.sleep(0.05 if wait is None else wait)
+        self.waited += time.monotonic() - start
+
+    def release(self, tokens=0, used_tokens=None):
+        """请求结束后释放并发额度，并用实际用量修正预估的token数"""
+        with self.condition:
+            self.running -= 1
+            if self.tpm and used_tokens is not None:
+                self.token_tokens = min(self.tpm, self.token_tokens + tokens - used_tokens)
+            self.condition.notify_all()
+
+    def headroom(self):
+        """剩余额度的比例，0表示需要排队"""
+        with self.condition:
+            self._refill(time.monotonic())
+            ratios = []
+            if self.rpm:
+                ratios.append(self.request_tokens / self.rpm)
+            if self.tpm:
+                ratios.append(self.token_tokens / self.tpm)
+            if self.concurrency:
+                ratios.append(1 - self.running / self.concurrency)
+            return max(0, min(ratios)) if ratios else 1
+
+    def stats(self):
+        return {
+            'running': self.running,
+            'queued': self.queued,
+            'waited': self.waited,
+            'headroom': self.headroom(),
+        }
+
+
+def get_limiter(name, limits=None):
+    """同一个name共用一个限流器，limits只在第一次创建时生效"""
+    with _limiters_lock:
+        limiter = _limiters.get(name)
+        if limiter is None:
+            limiter = RateLimiter(**(limits or {}))
+            _limiters[name] = limiter
+        return limiter
+
+
+def headroom(name):
+    """某个限流器的剩余额度比例，还没有创建限流器时返回1，不会创建新的限流器"""
+    with _limiters_lock:
+        limiter = _limiters.get(name)
+    return limiter.headroom() if limiter else 1
+
+
+def configure_limiter(name, **limits):
+    """修改某个限流器的限制，已经在使用的Request也会生效；server的name用paradigm.provider_key(server)得到"""
+    limiter = get_limiter(name)
+    with limiter.condition:
+        for key, value in limits.items():
+            setattr(limiter, key, value)
+        limiter.request_tokens = min(limiter.request_tokens, limiter.rpm) if limiter.rpm else limiter.rpm
+        limiter.token_tokens = min(limiter.token_tokens, limiter.tpm) if limiter.tpm else limiter.tpm
+        limiter.condition.notify_all()
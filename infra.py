@@ -1,10 +1,16 @@
 import paradigm
 import statics
+import budget
+import tracing
+import router
+import session_store
 import json
+import asyncio
 from types import SimpleNamespace
 import copy
 import threading
 import queue
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
 from functools import partial
 
 
@@ -19,17 +25,126 @@ class QuietThread(threading.Thread):
             pass  # 如果你想要完全无视错误，只需要pass即可
 
 
+# 所有Task/Talk共用的线程池：max_workers是同时运行的任务数，max_pending是等待中的任务数上限
+# 队列满时的处理方式policy：block等待空位，caller_runs在调用者的线程中直接运行，reject抛出TaskQueueFull
+EXECUTOR_CONFIG = {
+    'max_workers': 32,
+    'max_pending': 256,
+    'policy': 'block',
+}
+_executor = None
+_executor_lock = threading.Lock()
+
+
+class TaskQueueFull(Exception):
+    pass
+
+
+class BoundedExecutor:
+    """有界的线程池，submit返回Future，任务的返回值或异常保存在Future中"""
+    def __init__(self, max_workers=32, max_pending=256, policy='block'):
+        self.policy = policy
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='task')
+        self.slots = threading.BoundedSemaphore(max_workers + max_pending)
+        self.stats = {'submitted': 0, 'rejected': 0, 'caller_runs': 0}
+
+    def submit(self, func, *args, **kwargs):
+        if not self.slots.acquire(blocking=self.policy == 'block'):
+            if self.policy == 'caller_runs':
+                self.stats['caller_runs'] += 1
+                return self.run_in_caller(func, *args, **kwargs)
+            self.stats['rejected'] += 1
+            raise TaskQueueFull('任务队列已满')
+        self.stats['submitted'] += 1
+        try:
+            future = self.pool.submit(tracing.wrap(func), *args, **kwargs)
+        except Exception:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+        return future
+
+    @staticmethod
+    def run_in_caller(func, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(func(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def shutdown(self, wait=True):
+        self.pool.shutdown(wait=wait)
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = BoundedExecutor(**EXECUTOR_CONFIG)
+        return _executor
+
+
+def configure_executor(**config):
+    """修改共用线程池的配置，之后提交的任务使用新的线程池，已经提交的任务继续运行"""
+    global _executor
+    EXECUTOR_CONFIG.update(config)
+    with _executor_lock:
+        old, _executor = _executor, None
+    if old:
+        old.shutdown(wait=False)
+
+
+# service_info中传给paradigm.Request的参数
+REQUEST_OPTIONS = ('timeout', 'hedge', 'fallback')
+
+
 class Service:
-    def __init__(self, name, server, model='',timeout=0):
+    def __init__(self, name, server, model='',timeout=0, hedge=False, fallback=None):
         self.name = name
         self.params = {}
         self.on_call_list = []
+        # 上下文预算，为None时发送全部消息
+        self.budget = None
+        # 每次请求开头固定不变的消息，保持完全相同的内容和顺序，服务端的上下文缓存才能命中
+        self.prefix = []
             
-        self.request = paradigm.Request(server, model) if model else paradigm.Request(server)
+        # timeout是每次请求（包括重试）的总时限，为0时不限制；hedge和fallback见paradigm.Request
+        # server为'router'时model是请求类别，由router在多个服务商之间选择，失败时由router换服务商，不使用对冲请求
+        if server == 'router':
+            self.request = router.RouterRequest(model or 'chat', timeout=timeout or 0)
+        else:
+            self.request = paradigm.Request(server, model, timeout=timeout or 0, hedge=hedge, fallback=fallback) \
+                if model else paradigm.Request(server, timeout=timeout or 0, hedge=hedge, fallback=fallback)
 
     def set_params(self, params):
         self.params.update(params)
 
+    def set_budget(self, policy='pin_system', **kwargs):
+        """设置上下文预算，参数见budget.ContextBudget"""
+        if 'reserve' not in kwargs and self.params.get('max_tokens'):
+            kwargs['reserve'] = self.params['max_tokens']
+        self.budget = budget.ContextBudget(self.request.model, policy, **kwargs)
+
+    def set_prefix(self, messages):
+        """设置固定的前缀消息，如system prompt和输出格式说明，之后respond只需要传入变化的部分"""
+        self.prefix = [{'role': message['role'], 'content': message['content']} for message in messages]
+
+    def apply_prefix(self, messages):
+        # 没有消息时不发送，不能只发送前缀
+        if not self.prefix or not messages:
+            return messages
+        # 已经以相同内容开头时替换成保存的前缀，保证发送的字节完全一致
+        if messages[:len(self.prefix)] == self.prefix:
+            messages = messages[len(self.prefix):]
+        # 调用方自己的system消息接在前缀的system消息后面，不发送两条system消息
+        systems = [i for i, message in enumerate(self.prefix) if message['role'] == 'system']
+        if messages and messages[0].get('role') == 'system' and systems:
+            i = systems[-1]
+            merged = dict(self.prefix[i], content=f"{self.prefix[i]['content']}\n{messages[0]['content']}")
+            return self.prefix[:i] + [merged] + self.prefix[i + 1:] + messages[1:]
+        return self.prefix + messages
+
     def add_tools(self, tools: list):
         for tool in tools:
             self.on_call_list.append(tool)
@@ -46,17 +161,19 @@ class Service:
             params = self.request.define_tools(self.on_call_list)
             self.set_params(params)
 
-    def respond(self, messages, silent=False, show_name=None, **kwargs):
-        if not messages:
-            return
-        # print(messages)
-        if not show_name:
-            show_name = self.name
+    def prepare_messages(self, messages):
+        """发送前对messages的处理，子类可以重写"""
+        return messages
+
+    def merge_params(self, kwargs):
         params = copy.deepcopy(self.params)
         for key, value in kwargs.items():
             params[key] = value
-        self.request.call(messages, **params)
-        result = self.request.read_response()
+        return params
+
+    def show_result(self, result, silent=False, show_name=None):
+        if not show_name:
+            show_name = self.name
         if isinstance(result, Exception):
             print(show_name + ': An error occured.\n'+f"{result}")
         else:
@@ -64,13 +181,46 @@ class Service:
                 print(show_name + ':' + f"{result['show_msg']}")
                 print('\n')
             return result
+
+    @tracing.traced('Service.respond', lambda self, *args, **kwargs: {'service': self.name, 'server': self.request.server,
+                                                                      'model': self.request.model})
+    def respond(self, messages, silent=False, show_name=None, **kwargs):
+        messages = self.apply_prefix(self.prepare_messages(messages))
+        if not messages:
+            return
+        # print(messages)
+        params = self.merge_params(kwargs)
+        self.request.call(messages, **params)
+        return self.show_result(self.request.read_response(), silent, show_name)
+
+    @tracing.traced('Service.respond', lambda self, *args, **kwargs: {'service': self.name, 'server': self.request.server,
+                                                                      'model': self.request.model})
+    async def arespond(self, messages, silent=False, show_name=None, **kwargs):
+        """respond的异步版本"""
+        messages = self.apply_prefix(self.prepare_messages(messages))
+        if not messages:
+            return
+        params = self.merge_params(kwargs)
+        await self.request.acall(messages, **params)
+        return self.show_result(self.request.read_response(), silent, show_name)
         
-    def queue_respond(self, messages, result_queue, order=0, reply_type='public', task=''):
+    def queue_respond(self, messages, result_queue, order=0, reply_type='public', task='', silent=False):
         if task =='deal_recall':
             result = self.answer_with_func_msg(messages)
         else:
-            result = self.respond(messages)
+            result = self.respond(messages, silent=silent)
+        self.queue_result(result, result_queue, order, reply_type, task)
+        return result
+
+    async def aqueue_respond(self, messages, result_queue, order=0, reply_type='public', task='', silent=False):
+        if task =='deal_recall':
+            result = await self.aanswer_with_func_msg(messages)
+        else:
+            result = await self.arespond(messages, silent=silent)
+        self.queue_result(result, result_queue, order, reply_type, task)
+        return result
 
+    def queue_result(self, result, result_queue, order=0, reply_type='public', task=''):
         if result['call_msg']:
             # 处理tool_call的消息
             reply_type = 'private'
@@ -91,6 +241,7 @@ class Service:
                                          reply_type=reply_type))
 
 
+    @tracing.traced('Service.receive_recall', lambda self, call_msg: {'service': self.name, 'calls': len(call_msg)})
     def receive_recall(self, call_msg):
         result = []
         for msg in call_msg:
@@ -108,6 +259,14 @@ class Service:
         self.params['tool_choice'] = defined_tool_choice
         return result
 
+    async def aanswer_with_func_msg(self, messages):
+        defined_tool_choice = self.params['tool_choice']
+        if not isinstance(self.params['tool_choice'], str):
+            self.params['tool_choice'] = "none"
+        result = await self.arespond(messages)
+        self.params['tool_choice'] = defined_tool_choice
+        return result
+
 
 class Function:
     # 理论上应该是Tools类，但目前除了function外没有其他tool可用……
@@ -133,10 +292,45 @@ class Talker(Service):
         model = service_info.get('model')
         timeout = service_info.get('timeout')
         super().__init__(name, server, model, timeout)
+        # 持久化的会话日志，见persist
+        self.store = None
+        self.store_pending = False
         self.context = []
         if system_prompt:
             self.context.append({'role': 'system', 'content': system_prompt})
 
+    @property
+    def context(self):
+        if self.store_pending:
+            self.rehydrate()
+        return self._context
+
+    @context.setter
+    def context(self, context):
+        # 整体替换（restart、预算截断）时写入checkpoint，预算内的上下文大小有限
+        replaced = getattr(self, '_context', None) is not context
+        self._context = context
+        if self.store and replaced:
+            self.store.checkpoint(context)
+
+    def persist(self, path, **kwargs):
+        """
+        把上下文追加写入path下的会话日志，参数见session_store.SessionStore
+        path中已经有记录时，第一次用到context时才读取并恢复
+        """
+        self.store = session_store.SessionStore(path, snapshot=lambda: self.context, **kwargs)
+        if self.store.exists():
+            self.store_pending = True
+        else:
+            self.store.checkpoint(self.context)
+        return self.store
+
+    def rehydrate(self):
+        self.store_pending = False
+        state, entries = self.store.load()
+        self._context = state or []
+        self._context += [entry['msg'] for entry in entries]
+
     def restart(self):
         new_context = []
         if self.context and self.context[0]['role'] == 'system':
@@ -150,22 +344,33 @@ class Talker(Service):
             self.context[0]['content'] = system_prompt
         else:
             self.context.insert(0,{'role': 'system', 'content': system_prompt})
+        if self.store:
+            self.store.checkpoint(self.context)
 
     def add(self, message):
         self.context.append(message)
+        if self.store:
+            self.store.append({'t': 'add', 'msg': message})
 
-    def send(self, content='', message=None, silent=False):
+    def send(self, content='', message=None, silent=False, on_delta=None):
+        # 传入on_delta时流式返回，每段新内容都会回调on_delta
         if message:
-            self.context.append(message)
+            self.add(message)
         elif content:
-            self.context.append({'role': 'user', 'content': content})
+            self.add({'role': 'user', 'content': content})
         # print(self.params)
         # print(self.context)
 
-        result = self.respond(self.context, silent=silent)
+        if self.budget:
+            self.context = self.budget.fit(self.context)
+
+        if on_delta:
+            result = self.respond(self.context, silent=silent, stream=True, on_delta=on_delta)
+        else:
+            result = self.respond(self.context, silent=silent)
         
         if result['record_msg']:
-            self.context.append(result['record_msg'])
+            self.add(result['record_msg'])
         if result['call_msg']:
             func_msg = self.receive_recall(result['call_msg'])
             n = 0
@@ -173,14 +378,14 @@ class Talker(Service):
                 for msg in func_msg:
                     try:
                         func_str = json.dumps(msg)
-                        self.context.append(self.request.dump_tool_call_msg(tool_msg=func_str))
+                        self.add(self.request.dump_tool_call_msg(tool_msg=func_str))
                         # TODO：如果有多个工具返回，目前是插入多条tool消息，不确定是否能正常处理，需要验证
                         n += 1
                     except Exception:
                         continue
             if n > 0:
                 result = self.answer_with_func_msg(self.context)
-                self.context.append(result['record_msg'])
+                self.add(result['record_msg'])
 
     def read_context(self):
         result = ""
@@ -190,15 +395,30 @@ class Talker(Service):
         return result
 
 class Agent(Service):
-    def __init__(self, name, server,  model='', controller=None, **kwargs):
-        super().__init__(name, server, model)
+    def __init__(self, name, server,  model='', controller=None, timeout=0, hedge=False, fallback=None, **kwargs):
+        super().__init__(name, server, model, timeout, hedge, fallback)
         self.properties = kwargs
         self.controller = controller
         self.working_threads = []
         self.stop_event = threading.Event()
         self.states = {}
-
-    def respond(self, messages, silent=False, show_name=None, **kwargs):
+        self.store = None
+
+    def persist(self, path, **kwargs):
+        """把states写入path下的会话日志，已经有记录时先恢复，之后每次think和control的一轮结束时保存"""
+        self.store = session_store.SessionStore(path, snapshot=lambda: self.states, **kwargs)
+        state, entries = self.store.load()
+        if entries:
+            self.states = entries[-1]['states']
+        elif state is not None:
+            self.states = state
+        return self.store
+
+    def save_states(self):
+        if self.store:
+            self.store.append({'t': 'states', 'states': self.states})
+
+    def prepare_messages(self, messages):
         task_system_prompt = 0
         if 'guidance' in self.states.keys():
             if self.states['guidance']:
@@ -216,7 +436,7 @@ class Agent(Service):
                 messages = statics.remove_system_prompt(messages)
                 messages.insert(0,{'role': 'system', 'content':self.properties['system_prompt']})
 
-        return super().respond(messages, silent, show_name, **kwargs)
+        return messages
     
     def prepare(self):
         if (processes:= self.properties.get('pres')):
@@ -235,6 +455,7 @@ class Agent(Service):
                 self.states[result_key] = result['show_msg']
         else:
             self.states[result_key] = [result['show_msg']]
+        self.save_states()
     
     def control(self):
         i = self.states.get('control_round', 0)
@@ -249,6 +470,7 @@ class Agent(Service):
                 # controoler用到的参数通过states及properties传递s
                 # congtroller中直接向states中写入数据
                 i += 1
+                self.save_states()
                 if break_flag:
                     break
 
@@ -292,7 +514,10 @@ class Task:
         for service in services:
             self.create_service(service)
         # self.cuhaorrent_task_service = []
-        self.threads = []
+        # 已经提交还没有处理结果的任务
+        self.futures = []
+        # 失败的任务：(service名, 异常)
+        self.errors = []
         self.result_queue = queue.Queue()
 
         self.process = [] # 一系列pipeline处理逻辑，每个task只能有一个pipeline
@@ -316,10 +541,12 @@ class Task:
             service_info.pop('model')
         else:
             model = ''
+        # 请求相关的参数交给Request，Agent的其余参数保存在properties中
+        request_options = {key: service_info.pop(key) for key in REQUEST_OPTIONS if key in service_info}
         if agent:
-            service = Agent(name, server, model, **service_info)
+            service = Agent(name, server, model, **request_options, **service_info)
         else:
-            service = Service(name, server, model)
+            service = Service(name, server, model, **request_options)
         self.services.append(service)
 
     def get_service(self, service_name):
@@ -346,11 +573,26 @@ class Task:
                     task_services.append(service)
         return task_services
 
+    @tracing.traced('Task.assign', lambda self, messages, receivers=None, task='': {'task': task})
     def assign(self, messages, receivers=None, task=''):
         task_services = self.get_receivers(receivers)
         for service in task_services: 
             self._task_thread(service, messages, task)
         return self.receive()
+
+    @tracing.traced('Task.assign', lambda self, messages, receivers=None, task='': {'task': task})
+    async def aassign(self, messages, receivers=None, task=''):
+        """assign的异步版本，所有service的请求在同一个事件循环中并发，不再为每个service开线程"""
+        task_services = self.get_receivers(receivers)
+        jobs = []
+        for service in task_services:
+            self.hang_up(service)
+            jobs.append(service.aqueue_respond(messages, self.result_queue, task=task))
+        results = await asyncio.gather(*jobs, return_exceptions=True)
+        for service, result in zip(task_services, results):
+            if isinstance(result, Exception):
+                self.report_error(service.name, result)
+        return self.receive()
     
     def abs_assign(self, assign_list:list):
         for assign_message in assign_list:
@@ -370,48 +612,66 @@ class Task:
                 else:
                     task = ''
        
-                self._task_thread(receiver, messages, task)
+                self._task_thread(receiver, messages, task, assign_message.get('silent', False))
         
         return self.receive()
 
-    def _task_thread(self, service:Service, messages, task='',):
+    def dispatch(self, messages, receivers=None, task=''):
+        """只提交任务不等待，返回每个service的Future，结果仍然需要receive处理"""
+        return [self._task_thread(service, messages, task) for service in self.get_receivers(receivers)]
+
+    def submit(self, service, func, *args, **kwargs):
+        """把任务提交到共用的线程池，返回的Future记录了是哪个service的任务"""
+        future = get_executor().submit(func, *args, **kwargs)
+        future.service = service.name
+        self.futures.append(future)
+        return future
+
+    def wait_futures(self):
+        """等待所有已提交的任务，打印并记录失败的任务"""
+        futures, self.futures = self.futures, []
+        wait(futures)
+        for future in futures:
+            error = future.exception()
+            if error is not None:
+                self.report_error(future.service, error)
+
+    def report_error(self, service_name, error):
+        print(f'{service_name}: An error occured.\n{type(error).__name__}: {error}')
+        self.errors.append((service_name, error))
+
+    def _task_thread(self, service:Service, messages, task='', silent=False):
         self.hang_up(service)
-        thread = QuietThread(target=service.queue_respond, 
-                                   args=(messages, self.result_queue,),
-                                   kwargs={'task': task})
-        thread.start()
-        self.threads.append(thread)
+        return self.submit(service, service.queue_respond, messages, self.result_queue, task=task, silent=silent)
 
     def _multi_task_thread(self, service:Service, start_messages:list, dealing_functions:list):
         self.hang_up(service)
-        functions = [(partial(service.respond, start_messages, sllent=True))]
+        functions = [(partial(service.respond, start_messages, silent=True))]
         for function in dealing_functions:
             functions.append(function)
 
         def execute(functions):
+            # 每一步的返回值传给下一步，Future的结果是最后一步的返回值
             params = None
             for function in functions:
                 if params:
                     params = function(params)
                 else:
-                    function()
-        
-        thread = QuietThread(target=execute, args=(functions))
-        thread.start()
-        self.threads.append(thread)
+                    params = function()
+            return params
+
+        return self.submit(service, execute, functions)
 
     @staticmethod
     def hang_up(service:Service):
         if isinstance(service, Agent):
             service.hang_up()
 
+    @tracing.traced('Task.receive')
     def receive(self):
         """处理返回消息的函数"""
-        # 等待所有线程完成
-        for thread in self.threads:
-            thread.join()
-
-        self.threads = []
+        # 等待所有任务完成
+        self.wait_futures()
         report = []
         recursion = False
 
@@ -438,6 +698,45 @@ class Task:
         elif report:
             return report
         
+    def receive_iter(self, ordered=False):
+        """
+        逐个返回结果：每个service完成后立即处理它的结果（包括tool_call）并yield，不用等待最慢的service
+        ordered为True时和receive一样等待全部完成后再按顺序返回
+        """
+        if ordered:
+            yield from self.receive() or []
+            return
+        pending = set()
+        while True:
+            while not self.result_queue.empty():
+                yield from self.handle_result(self.result_queue.get())
+            # 处理tool_call时可能提交了新的任务
+            pending.update(self.futures)
+            self.futures = []
+            if not pending:
+                break
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                error = future.exception()
+                if error is not None:
+                    self.report_error(future.service, error)
+
+    def handle_result(self, result):
+        """receive_iter处理一个结果，返回需要yield的内容"""
+        if result.result_type == 'record':
+            yield {
+                'service': result.service,
+                'reply': result.reply,
+            }
+        elif result.result_type == 'call':
+            # Task没有上下文，只执行工具，不再请求service回答
+            self.get_service(result.service).receive_recall(result.reply)
+
+    def assign_iter(self, messages, receivers=None, task=''):
+        """assign的逐个返回版本"""
+        self.dispatch(messages, receivers, task)
+        yield from self.receive_iter()
+
     def add_process(self, process:Quest):
         self.process.append(process)
 
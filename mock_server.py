@@ -0,0 +1,364 @@
+# 本地的OpenAI兼容模拟服务，不需要API key，用于离线调试、性能测试和压力测试
+# Request(server='mock', port=...)会连接到这里
+# 可以配置延迟分布、生成速度、错误注入、tool_call返回，也可以回放录制好的返回（cassette）
+import argparse
+import json
+import math
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import budget
+import cache
+import paradigm
+
+MOCK_CONFIG = {
+    # 首token之前的延迟，格式见sample_latency
+    'latency': ('fixed', 0),
+    # 每秒生成的token数，为0时一次性返回
+    'tokens_per_second': 0,
+    # 返回错误的比例和使用的状态码
+    'error_rate': 0,
+    'error_codes': (429, 500, 503),
+    # 请求带有tools时，返回tool_call的比例
+    'tool_call_rate': 0,
+    # 生成返回内容的方式：echo、extraction，或者一个接收请求参数返回字符串的函数
+    'responder': 'echo',
+    # 回放的cassette文件（jsonl），没有录制的请求使用responder生成
+    'cassette': None,
+    # 录制模式：请求转发到这个server，返回写入cassette
+    'record_from': None,
+}
+
+
+def sample_latency(latency):
+    """
+    latency可以是秒数，或者(分布, 参数...)：
+        ('fixed', 秒数)
+        ('uniform', 最小, 最大)
+        ('lognormal', 中位数, sigma)
+        ('exponential', 平均值)
+    """
+    if isinstance(latency, (int, float)):
+        return latency
+    kind, *args = latency
+    match kind:
+        case 'fixed':
+            return args[0]
+        case 'uniform':
+            return random.uniform(args[0], args[1])
+        case 'lognormal':
+            return random.lognormvariate(math.log(args[0]), args[1]) if args[0] > 0 else 0
+        case 'exponential':
+            return random.expovariate(1 / args[0]) if args[0] > 0 else 0
+        case _:
+            raise ValueError(f'未知的延迟分布: {kind}')
+
+
+def parse_latency(text):
+    """解析命令行的延迟参数，如 0.5、uniform:0.2,1、lognormal:0.5,0.4"""
+    if ':' not in text:
+        return float(text)
+    kind, args = text.split(':', 1)
+    return (kind, *[float(arg) for arg in args.split(',')])
+
+
+def echo_responder(params):
+    content = ''
+    for message in reversed(params.get('messages', [])):
+        if message.get('role') == 'user' and isinstance(message.get('content'), str):
+            content = message['content']
+            break
+    return f'mock reply: {content[:50]}'
+
+
+def extraction_responder(params):
+    """按extraction.SCHEMA返回格式正确的提取结果，分项提取时只返回指定的一项"""
+    import extraction
+    content = params['messages'][-1].get('content', '')
+    system = params['messages'][0].get('content', '') if params['messages'] else ''
+    keys = list(extraction.SCHEMA)
+    if '需要提取的信息：' in content:
+        keys = [content.rsplit('需要提取的信息：', 1)[1].strip()]
+    elif found := re.search(r'json中只有"(.+?)"一个key', system or ''):
+        # 分项提取的小prompt把指定的一项写在system prompt中
+        keys = [found.group(1)]
+    result = {}
+    for key in keys:
+        match extraction.SCHEMA.get(key, str).__name__:
+            case 'dict':
+                result[key] = {'描述': f'模拟的{key}'}
+            case 'list':
+                result[key] = [f'模拟的{key}']
+            case _:
+                result[key] = f'模拟的{key}'
+    return json.dumps(result, ensure_ascii=False)
+
+
+RESPONDERS = {
+    'echo': echo_responder,
+    'extraction': extraction_responder,
+}
+
+
+def mock_tool_call(tool):
+    """为tools中的一个函数生成调用，必填参数使用占位的字符串"""
+    function = tool.get('function', {})
+    parameters = function.get('parameters') or {}
+    arguments = {name: 'mock' for name in parameters.get('required', [])}
+    return {
+        'id': f'call_{uuid.uuid4().hex[:12]}',
+        'type': 'function',
+        'function': {'name': function.get('name', ''), 'arguments': json.dumps(arguments, ensure_ascii=False)},
+    }
+
+
+def build_completion(params, message, finish_reason='stop'):
+    """按请求参数和生成的message拼装ChatCompletion格式的dict，用量按budget估计"""
+    prompt_tokens = budget.count_messages(params.get('messages', []))
+    completion_tokens = budget.count_text(message['content'] or json.dumps(message.get('tool_calls')))
+    return {
+        'id': f'chatcmpl-{uuid.uuid4().hex[:12]}',
+        'object': 'chat.completion',
+        'created': int(time.time()),
+        'model': params.get('model', 'mock'),
+        'choices': [{'index': 0, 'finish_reason': finish_reason, 'message': message}],
+        'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                  'total_tokens': prompt_tokens + completion_tokens},
+    }
+
+
+class Cassette:
+    """录制的返回，key是cache.request_key计算的请求hash，文件每行是{key, response}"""
+    def __init__(self, path):
+        self.path = path
+        self.responses = {}
+        self.lock = threading.Lock()
+        try:
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    if line.strip():
+                        item = json.loads(line)
+                        self.responses[item['key']] = item['response']
+        except FileNotFoundError:
+            pass
+
+    def get(self, params):
+        return self.responses.get(cache.request_key(params))
+
+    def add(self, params, response):
+        key = cache.request_key(params)
+        with self.lock:
+            self.responses[key] = response
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps({'key': key, 'response': response}, ensure_ascii=False) + '\n')
+
+
+class MockServer:
+    """
+    在后台线程运行的模拟服务，参数见MOCK_CONFIG
+    port为0时使用随机的空闲端口，启动后从self.port读取
+    """
+    def __init__(self, port=9091, host='127.0.0.1', **config):
+        self.config = dict(MOCK_CONFIG, **config)
+        self.cassette = Cassette(self.config['cassette']) if self.config['cassette'] else None
+        self.upstream = self.config['record_from']
+        if self.upstream and not self.cassette:
+            raise ValueError('录制模式需要指定cassette文件')
+
+        self.stats = {'requests': 0, 'errors': 0, 'tool_calls': 0, 'replayed': 0, 'recorded': 0}
+        self.stats_lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer((host, port), self._handler_class())
+        self.httpd.daemon_threads = True
+        self.port = self.httpd.server_address[1]
+        self.thread = None
+
+    @property
+    def url(self):
+        return f'http://{self.httpd.server_address[0]}:{self.port}/v1'
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def count(self, key):
+        with self.stats_lock:
+            self.stats[key] += 1
+
+    def respond_content(self, params):
+        responder = self.config['responder']
+        if not callable(responder):
+            responder = RESPONDERS[responder]
+        return responder(params)
+
+    def completion(self, params):
+        """生成非流式的返回（dict），tool_call和内容二选一"""
+        if self.cassette:
+            response = self.cassette.get(params)
+            if response is not None:
+                self.count('replayed')
+                return response
+        if self.upstream:
+            return self.record(params)
+
+        message = {'role': 'assistant', 'content': None}
+        finish_reason = 'stop'
+        tools = params.get('tools')
+        if tools and random.random() < self.config['tool_call_rate']:
+            message['tool_calls'] = [mock_tool_call(random.choice(tools))]
+            finish_reason = 'tool_calls'
+            self.count('tool_calls')
+        else:
+            message['content'] = self.respond_content(params)
+        return build_completion(params, message, finish_reason)
+
+    def record(self, params):
+        """录制模式：用真实的server完成请求，并把返回写入cassette"""
+        request = paradigm.Request(self.upstream, params.get('model', ''), response_cache=False)
+        kwargs = {key: value for key, value in params.items()
+                  if key not in ('model', 'messages', 'stream', 'stream_options')}
+        request.call(params['messages'], **kwargs)
+        response = request.response_list[-1].model_dump(exclude_none=True)
+        self.cassette.add(params, response)
+        self.count('recorded')
+        return response
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def send_json(self, status, body):
+                data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                if self.path.rstrip('/').endswith('/models'):
+                    self.send_json(200, {'object': 'list', 'data': [{'id': 'mock', 'object': 'model', 'owned_by': 'mock'}]})
+                else:
+                    self.send_json(404, {'error': {'message': 'not found', 'type': 'invalid_request_error'}})
+
+            def do_POST(self):
+                if not self.path.rstrip('/').endswith('/chat/completions'):
+                    self.send_json(404, {'error': {'message': 'not found', 'type': 'invalid_request_error'}})
+                    return
+                params = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                server.count('requests')
+                config = server.config
+
+                time.sleep(sample_latency(config['latency']))
+                if config['error_rate'] and random.random() < config['error_rate']:
+                    server.count('errors')
+                    status = random.choice(config['error_codes'])
+                    self.send_json(status, {'error': {'message': f'mock error {status}', 'type': 'mock_error',
+                                                      'code': status}})
+                    return
+
+                try:
+                    response = server.completion(params)
+                except Exception as e:
+                    server.count('errors')
+                    self.send_json(500, {'error': {'message': f'{type(e).__name__}: {e}', 'type': 'mock_error'}})
+                    return
+
+                if params.get('stream'):
+                    self.stream(response, params)
+                else:
+                    tokens_per_second = config['tokens_per_second']
+                    if tokens_per_second:
+                        time.sleep(response['usage']['completion_tokens'] / tokens_per_second)
+                    self.send_json(200, response)
+
+            def send_event(self, data):
+                payload = f'data: {data}\n\n'.encode('utf-8')
+                self.wfile.write(f'{len(payload):x}\r\n'.encode() + payload + b'\r\n')
+                self.wfile.flush()
+
+            def stream(self, response, params):
+                """按tokens_per_second的速度逐段返回SSE，include_usage时最后一个chunk带有用量"""
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+
+                base = {key: response[key] for key in ('id', 'created', 'model')}
+                base['object'] = 'chat.completion.chunk'
+                choice = response['choices'][0]
+                message = choice['message']
+                deltas = [{'role': 'assistant', 'content': ''}]
+                if message.get('tool_calls'):
+                    deltas.append({'tool_calls': [dict(tool_call, index=i)
+                                                  for i, tool_call in enumerate(message['tool_calls'])]})
+                else:
+                    content = message.get('content') or ''
+                    # 每段大约4个字符
+                    deltas += [{'content': content[i:i + 4]} for i in range(0, len(content), 4)]
+
+                completion_tokens = response.get('usage', {}).get('completion_tokens', 0)
+                tokens_per_second = server.config['tokens_per_second']
+                interval = completion_tokens / tokens_per_second / max(len(deltas) - 1, 1) if tokens_per_second else 0
+                for i, delta in enumerate(deltas):
+                    if i and interval:
+                        time.sleep(interval)
+                    self.send_event(json.dumps(dict(base, choices=[{'index': 0, 'delta': delta,
+                                                                    'finish_reason': None}]), ensure_ascii=False))
+                self.send_event(json.dumps(dict(base, choices=[{'index': 0, 'delta': {},
+                                                                'finish_reason': choice.get('finish_reason', 'stop')}])))
+                if (params.get('stream_options') or {}).get('include_usage') and response.get('usage'):
+                    self.send_event(json.dumps(dict(base, choices=[], usage=response['usage'])))
+                self.send_event('[DONE]')
+                self.wfile.write(b'0\r\n\r\n')
+                self.wfile.flush()
+
+        return Handler
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='本地的OpenAI兼容模拟服务')
+    parser.add_argument('--port', type=int, default=9091)
+    parser.add_argument('--latency', type=parse_latency, default=0,
+                        help='首token之前的延迟：秒数，或uniform:最小,最大、lognormal:中位数,sigma、exponential:平均值')
+    parser.add_argument('--tokens-per-second', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--tool-call-rate', type=float, default=0)
+    parser.add_argument('--responder', choices=list(RESPONDERS), default='echo')
+    parser.add_argument('--cassette', help='回放（或录制）使用的jsonl文件')
+    parser.add_argument('--record-from', help='录制模式：把请求转发到这个server，返回写入cassette')
+    args = parser.parse_args(argv)
+
+    server = MockServer(args.port, latency=args.latency, tokens_per_second=args.tokens_per_second,
+                        error_rate=args.error_rate, tool_call_rate=args.tool_call_rate,
+                        responder=args.responder, cassette=args.cassette, record_from=args.record_from)
+    print(f'mock server: {server.url}')
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+        print(server.stats)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,39 @@
-import copy
+import os
 import re
+import sys
 import json
+import asyncio
+import bisect
 from functools import partial
 from types import SimpleNamespace
 import statics
 import infra
+import tracing
+import session_store
+
+
+DISPLAY_TO_ALL = ('all',)
 
 
 class TalkRecord:
-    def __init__(self, order, msg, sender='user', display_to=['all']):
+    # 长对话中记录数量很多，使用__slots__减少每条记录的内存
+    __slots__ = ('order', 'sender', 'display_to', 'mask', 'msg')
+
+    def __init__(self, order, msg, sender='user', display_to=None):
         self.order = order
-        self.sender = sender
         # sender代表消息的来源，可能是user、system、tools或{service.name}
+        # 同一个名字在所有记录中只保存一份
+        self.sender = sys.intern(sender)
+        # 只有None表示所有service可见，空列表和原来一样表示没有service可见
+        if display_to is None:
+            display_to = DISPLAY_TO_ALL
+        elif isinstance(display_to, str):
+            display_to = (sys.intern(display_to),)
+        else:
+            display_to = tuple(sys.intern(name) for name in display_to)
         self.display_to = display_to
+        # mask是可见service的位掩码，-1表示所有service可见，None表示还没有计算
+        self.mask = -1 if 'all' in display_to else None
         self.msg = msg
 
     def check(self, service):
@@ -22,16 +43,53 @@ class TalkRecord:
 
 class Talk(infra.Task):
     def __init__(self, talk_services=[], system_prompt='', ):
+        # 持久化的会话日志，见persist
+        self.store = None
+        self.store_pending = False
         super().__init__(talk_services)
         
         self.records = []
+        # 每个service可见消息的索引，在添加记录时增量更新
+        self.context_index = {}
+        # 每个service名对应TalkRecord.mask中的一位
+        self.service_bits = {}
+        self.indexed = (id(self.records), 0)
         if system_prompt:
-            self.records.append(TalkRecord(0, {'role': 'system', 'content': system_prompt}, 'system'))
+            self.add_record(TalkRecord(0, {'role': 'system', 'content': system_prompt}, 'system'))
 
         self.current_order = 1
         self.main_task = ''
+        # 流式接收时暂存工具调用，等对应的call_record记录后再执行
+        self.pending_calls = {}
+
+    @property
+    def records(self):
+        if self.store_pending:
+            self.rehydrate()
+        return self._records
+
+    @records.setter
+    def records(self, records):
+        self._records = records
+
+    @property
+    def current_order(self):
+        # 新记录的order依赖恢复后的历史，读取前同样要先恢复
+        if self.store_pending:
+            self.rehydrate()
+        return self._current_order
+
+    @current_order.setter
+    def current_order(self, current_order):
+        self._current_order = current_order
 
     def update_system_prompt(self, system_prompt):
+        self._set_system_prompt(system_prompt)
+        if self.store:
+            self.store.append({'t': 'system', 'content': system_prompt})
+        self.reset_index()
+
+    def _set_system_prompt(self, system_prompt):
         if not self.records:
             self.records.insert(0, TalkRecord(0, {'role': 'system', 'content': system_prompt}, 'system'))
         elif self.records[0].msg['role'] == 'system':
@@ -39,27 +97,133 @@ class Talk(infra.Task):
         else:
             self.records.insert(0, TalkRecord(0, {'role': 'system', 'content': system_prompt}, 'system'))
 
+    def restart(self):
+        super().restart()
+        if self.store:
+            self.store.append({'t': 'restart'})
+        self.reset_index()
+
+    def persist(self, path, **kwargs):
+        """
+        把对话记录追加写入path下的会话日志，参数见session_store.SessionStore
+        path中已经有记录时，第一次用到records或current_order时才读取并恢复，之后的记录接着写入
+        """
+        self.store = session_store.SessionStore(path, snapshot=self.snapshot, **kwargs)
+        if self.store.exists():
+            self.store_pending = True
+        else:
+            self.store.checkpoint(self.snapshot())
+        return self.store
+
+    def snapshot(self):
+        return {'records': [self.encode_record(record) for record in self.records], 'current_order': self.current_order}
+
+    @staticmethod
+    def encode_record(record):
+        return {'t': 'record', 'order': record.order, 'sender': record.sender,
+                'display_to': None if 'all' in record.display_to else list(record.display_to), 'msg': record.msg}
+
+    def rehydrate(self):
+        """从会话日志的最后一个checkpoint恢复，再重放之后的记录"""
+        self.store_pending = False
+        state, entries = self.store.load()
+        if state is not None:
+            self._records = [TalkRecord(item['order'], item['msg'], item['sender'], item['display_to'])
+                             for item in state['records']]
+            self.current_order = state['current_order']
+        for entry in entries:
+            match entry['t']:
+                case 'record':
+                    record = TalkRecord(entry['order'], entry['msg'], entry['sender'], entry['display_to'])
+                    self._records.insert(bisect.bisect_right(self._records, record.order, key=lambda x: x.order),
+                                         record)
+                    self.current_order = max(self.current_order, record.order + 1)
+                case 'system':
+                    self._set_system_prompt(entry['content'])
+                case 'restart':
+                    infra.Task.restart(self)
+        self.reset_index()
+
+    def set_budget(self, policy='pin_system', receivers=None, **kwargs):
+        """为对话中的service设置上下文预算，参数见budget.ContextBudget"""
+        for service in self.get_receivers(receivers):
+            service.set_budget(policy, **kwargs)
+
+    def add_record(self, record):
+        """添加记录，并更新已经建立的可见消息索引，先发出后返回的记录按order插入到正确的位置"""
+        if self.records and record.order < self.records[-1].order:
+            self.records.insert(bisect.bisect_right(self.records, record.order, key=lambda x: x.order), record)
+        else:
+            self.records.append(record)
+        if self.indexed == (id(self.records), len(self.records) - 1):
+            for (service_name, use_tools), index in self.context_index.items():
+                self._index_record(index, record, service_name, use_tools)
+            self.indexed = (id(self.records), len(self.records))
+        if self.store:
+            self.store.append(self.encode_record(record))
+
+    def reset_index(self):
+        self.context_index = {}
+        self.indexed = (id(self.records), len(self.records))
+
+    def service_bit(self, service_name):
+        bit = self.service_bits.get(service_name)
+        if bit is None:
+            bit = 1 << len(self.service_bits)
+            self.service_bits[service_name] = bit
+        return bit
+
+    def record_mask(self, record):
+        if record.mask is None:
+            mask = 0
+            for name in record.display_to:
+                mask |= self.service_bit(name)
+            record.mask = mask
+        return record.mask
+
+    def _index_record(self, index, record, service_name, use_tools):
+        if not use_tools and record.sender == 'tools':
+            # 除非用到工具，否则不处理工具结果
+            return
+        if not self.record_mask(record) & self.service_bit(service_name):
+            return
+        msg = record.msg
+        if record.sender not in ['user', 'system', 'tools'] and record.sender != service_name:
+            # 只有需要修改role时才复制，其余消息在索引中直接引用原始记录
+            msg = dict(msg, role=record.sender)
+        # order相同的记录保持添加的先后顺序，和原先的稳定排序一致
+        position = bisect.bisect_right(index.orders, record.order)
+        if position == len(index.orders):
+            index.orders.append(record.order)
+            index.messages.append(msg)
+        else:
+            index.orders.insert(position, record.order)
+            index.messages.insert(position, msg)
+
     def get_related_context(self, service, use_tools=False):
-        """在record.check的基础上，修改其他服务的role为对应的{service.name}并排序"""
-        related = []
+        """
+        在record.check的基础上，修改其他服务的role为对应的{service.name}并排序
+        返回的消息和Talk.records中的记录共用，需要修改某条消息时先复制（参考map_task_messages）
+        索引省掉了每轮的筛选和排序，但复制列表以及map_task_messages逐条处理仍然和可见的消息数成正比，
+        每轮的耗时随历史线性增长（和把全部消息序列化发送给模型的开销同阶），见benchmark.bench_related_context
+        """
         if isinstance(service, str):
           service = self.get_service(service)
-        for record in self.records:
-            if not use_tools and record.sender == 'tools':
-                # 除非用到工具，否则不处理工具结果
-                continue
-            if record.check(service):
-                related.append(record)
-        sorted_records = sorted(related, key=lambda x: x.order)
-
-        context = []
-        for record in sorted_records:
-            msg = copy.deepcopy(record.msg)
-            if record.sender not in ['user', 'system', 'tools'] and record.sender != service.name:
-                msg['role'] = record.sender
-            context.append(msg)
-        return context
-
+        if self.indexed != (id(self.records), len(self.records)):
+            # records被直接修改过，重新建立索引
+            self.reset_index()
+
+        key = (service.name, use_tools)
+        index = self.context_index.get(key)
+        if index is None:
+            index = SimpleNamespace(orders=[], messages=[])
+            for record in self.records:
+                self._index_record(index, record, service.name, use_tools)
+            self.context_index[key] = index
+        return list(index.messages)
+
+    @tracing.traced('Talk.map_task_messages', lambda self, service, task='', *args, **kwargs: {'service': service.name,
+                                                                                              'task': task})
     def map_task_messages(self, service, task='', instruct='', instruct_type='guidance'):
         """根据task类型map发送给service的消息"""
         if task in ['deal_recall']:
@@ -71,13 +235,13 @@ class Talk(infra.Task):
         match task:
             case 'group_discussion':
                 for msg in raw_messages:
+                    # raw_messages是共用的索引，修改前先复制
                     if msg['role'] == 'system':
-                        msg['content'] = f"{msg['content']}\n你在这次讨论中扮演{service.name}\n其他角色由用户扮演，你不需要替其他角色说话"
+                        msg = dict(msg, content=f"{msg['content']}\n你在这次讨论中扮演{service.name}\n其他角色由用户扮演，你不需要替其他角色说话")
                     # elif msg['role'] == 'assistant':
                     #     msg['content'] = f"（我是{service.name}，我说）: {msg['content']}"
                     elif msg['role'] not in ['system', 'assistant', 'user']:
-                        msg['content'] = f"{msg['role']}说: {msg['content']}"
-                        msg['role'] = 'user'
+                        msg = dict(msg, content=f"{msg['role']}说: {msg['content']}", role='user')
                     task_messages.append(msg)
                 if not any(msg.get('role') == 'system' for msg in task_messages):
                     identity_msg = {
@@ -94,8 +258,7 @@ class Talk(infra.Task):
                 # 将所有其他模型返回的消息视为为用户消息
                 for msg in raw_messages:
                     if msg['role'] not in ['system', 'assistant', 'user']:
-                        msg['content'] = f"{msg['role']}: {msg['content']}"
-                        msg['role'] = 'user'
+                        msg = dict(msg, content=f"{msg['role']}: {msg['content']}", role='user')
                     task_messages.append(msg)
 
         # 处理instruct
@@ -116,6 +279,9 @@ class Talk(infra.Task):
                     'content': instruct,
                 })
 
+        if service.budget:
+            task_messages = service.budget.fit(task_messages)
+
         # 定义返回类型
         if task in ['1on1']:
             reply_type = 'private'
@@ -127,12 +293,12 @@ class Talk(infra.Task):
     def send(self, content='', role_message=None):
         # 可以发送空消息，但不会记录
         if content:
-            self.records.append(TalkRecord(self.current_order, {'role': 'user', 'content': content}))
+            self.add_record(TalkRecord(self.current_order, {'role': 'user', 'content': content}))
         elif role_message:
             if role_message['role'] == 'user':
-                self.records.append(TalkRecord(self.current_order, role_message))
+                self.add_record(TalkRecord(self.current_order, role_message))
             elif role_message['role'] == 'system':
-                self.records.append(TalkRecord(self.current_order, role_message, 'system'))
+                self.add_record(TalkRecord(self.current_order, role_message, 'system'))
             else:
                 service_names = []
                 for service in self.services:
@@ -142,9 +308,9 @@ class Talk(infra.Task):
                     role_message['role'] = 'assistant'
                     if 'display_to' in role_message.keys():
                         display_to = role_message['display_to']
-                        self.records.append(TalkRecord(self.current_order, role_message, sender, display_to))
+                        self.add_record(TalkRecord(self.current_order, role_message, sender, display_to))
                     else:
-                        self.records.append(TalkRecord(self.current_order, role_message, sender))
+                        self.add_record(TalkRecord(self.current_order, role_message, sender))
         else:
             self.current_order -= 1
 
@@ -160,13 +326,14 @@ class Talk(infra.Task):
 
     def record(self, result, tool=False):
         if tool:
-            self.records.append(TalkRecord(result.order, result.reply, 'tools', [result.service]))
+            self.add_record(TalkRecord(result.order, result.reply, 'tools', [result.service]))
         elif result.reply_type == 'public':
-            self.records.append(TalkRecord(result.order, result.reply, result.service))
+            self.add_record(TalkRecord(result.order, result.reply, result.service))
         elif result.reply_type == 'private':
-            self.records.append(TalkRecord(result.order, result.reply, result.service, [result.service]))
+            self.add_record(TalkRecord(result.order, result.reply, result.service, [result.service]))
         self.current_order += 1
 
+    @tracing.traced('Talk.assign', lambda self, receivers=None, task='', *args, **kwargs: {'task': task})
     def assign(self, receivers=None, task='', instruct='', reply_type='', messages=None):
         # assign 和 send 分开，可以自动执行一些预定义的task
         # instruct是不进入聊天记录的指令
@@ -179,6 +346,26 @@ class Talk(infra.Task):
             self._task_thread(service, task, instruct, reply_type, messages)
         
         return self.receive()
+
+    @tracing.traced('Talk.assign', lambda self, receivers=None, task='', *args, **kwargs: {'task': task})
+    async def aassign(self, receivers=None, task='', instruct='', reply_type='', messages=None):
+        """assign的异步版本，所有service的请求在同一个事件循环中并发"""
+        task_services = self.get_receivers(receivers)
+
+        if not task:
+            task = self.main_task
+
+        jobs = []
+        for service in task_services:
+            task_messages, task_reply_type = self.prepare_task(service, task, instruct, reply_type, messages)
+            jobs.append(service.aqueue_respond(task_messages, self.result_queue, self.current_order,
+                                               task_reply_type, task))
+        results = await asyncio.gather(*jobs, return_exceptions=True)
+        for service, result in zip(task_services, results):
+            if isinstance(result, Exception):
+                self.report_error(service.name, result)
+
+        return await self.areceive()
     
     def prim_assign(self, receiver:infra.Service, reply_type='report', messages=None, dealing_functions=None):
         """
@@ -227,27 +414,27 @@ class Talk(infra.Task):
         
         return self.receive()
 
-    def _task_thread(self, service:infra.Service, task='', instruct='', reply_type='', messages=None):
+    def prepare_task(self, service:infra.Service, task='', instruct='', reply_type='', messages=None):
+        """确定发送给service的消息和返回类型"""
         if messages and reply_type:
             task_messages = messages
         else:
             mapped_messages, mapped_reply_type = self.map_task_messages(service, task, instruct)
-            if not messages:
-                task_messages = mapped_messages
+            task_messages = messages if messages else mapped_messages
             if not reply_type:
                 reply_type = mapped_reply_type
-        thread = infra.QuietThread(target=service.queue_respond, 
-                                   args=(task_messages, self.result_queue, self.current_order, reply_type, task))
-        thread.start()
-        self.threads.append(thread)
+        return task_messages, reply_type
+
+    def _task_thread(self, service:infra.Service, task='', instruct='', reply_type='', messages=None):
+        task_messages, reply_type = self.prepare_task(service, task, instruct, reply_type, messages)
+        return self.submit(service, service.queue_respond, task_messages, self.result_queue, self.current_order,
+                           reply_type, task)
              
+    @tracing.traced('Task.receive')
     def receive(self):
         """处理返回消息的函数"""
-        # 等待所有线程完成
-        for thread in self.threads:
-            thread.join()
-
-        self.threads = []
+        # 等待所有任务完成
+        self.wait_futures()
         report = []
         recursion = False
 
@@ -270,7 +457,7 @@ class Talk(infra.Task):
                     for msg in func_msg:
                         try:
                             recall_msg = service.request.dump_tool_call_msg(tool_msg=json.dumps(msg))
-                            self.records.append(TalkRecord(result.order, recall_msg, 'tools', [result.service]))
+                            self.add_record(TalkRecord(result.order, recall_msg, 'tools', [result.service]))
                             self.assign(receivers=[result.service], task='deal_recall')
                             recursion = True
                         except Exception:
@@ -281,6 +468,74 @@ class Talk(infra.Task):
         elif report:
             return report
 
+    def handle_result(self, result):
+        """receive_iter处理一个结果：记录到对话中并yield，tool_call执行后再让service回答"""
+        if result.result_type == 'record':
+            if result.reply_type != 'report':
+                self.record(result)
+            yield {
+                'service': result.service,
+                'reply': result.reply,
+            }
+        elif result.result_type == 'call':
+            # 同一个service的call_record紧跟在后面，先记录带有tool_calls的消息，再记录工具的返回
+            self.pending_calls[result.service] = result
+        elif result.result_type == 'call_record':
+            self.record(result, tool=True)
+            call = self.pending_calls.pop(result.service, None)
+            if call:
+                service = self.get_service(call.service)
+                func_msg = service.receive_recall(call.reply)
+                for msg in func_msg or []:
+                    recall_msg = service.request.dump_tool_call_msg(tool_msg=json.dumps(msg))
+                    self.add_record(TalkRecord(call.order, recall_msg, 'tools', [call.service]))
+                if func_msg:
+                    self._task_thread(service, task='deal_recall')
+
+    def assign_iter(self, receivers=None, task='', instruct='', reply_type='', messages=None):
+        """assign的逐个返回版本：每个service回答后立即yield，记录仍然按order保存在records中"""
+        if not task:
+            task = self.main_task
+        for service in self.get_receivers(receivers):
+            self._task_thread(service, task, instruct, reply_type, messages)
+        yield from self.receive_iter()
+
+    @tracing.traced('Task.receive')
+    async def areceive(self):
+        """receive的异步版本，工具返回后的再次请求也通过aassign发出"""
+        report = []
+        recursion = False
+
+        while not self.result_queue.empty():
+            result = self.result_queue.get()
+            if result.result_type == 'record':
+                if result.reply_type == 'report':
+                    report.append({
+                        'service': result.service,
+                        'reply': result.reply,
+                    })
+                else:
+                    self.record(result)
+            elif result.result_type == 'call_record':
+                self.record(result, tool=True)
+            elif result.result_type == 'call':
+                service = self.get_service(result.service)
+                func_msg = service.receive_recall(result.reply)
+                if func_msg:
+                    for msg in func_msg:
+                        try:
+                            recall_msg = service.request.dump_tool_call_msg(tool_msg=json.dumps(msg))
+                            self.add_record(TalkRecord(result.order, recall_msg, 'tools', [result.service]))
+                            await self.aassign(receivers=[result.service], task='deal_recall')
+                            recursion = True
+                        except Exception:
+                            continue
+
+        if recursion:
+            return await self.areceive()
+        elif report:
+            return report
+
 
 class DM:
     """
@@ -408,7 +663,18 @@ class DM:
                     print(service.name)
                     service.request.count_usage()
                     print('\n')
-            # TODO：save_history, 保存对话记录
+            case 'save_history':
+                # save_history [目录]：之后的对话记录会持续追加写入，已经保存过时写入一个checkpoint
+                if self.talk.store is None:
+                    # 路径可能以/开头，不能使用para
+                    path = user_input[len(command):].strip() or input('Please enter a directory to save history: ')
+                    self.talk.persist(path)
+                    for service in self.talk.services:
+                        if isinstance(service, infra.Agent):
+                            service.persist(os.path.join(path, 'agents', service.name))
+                else:
+                    self.talk.store.compact()
+                print(f'history saved to {self.talk.store.path}')
             case 'send_to':
                 if not para:
                     receivers = input('Please enter a list of services separated by space: ').split()
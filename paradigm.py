@@ -1,6 +1,21 @@
-from openai import OpenAI
+# openai SDK和httpx在第一次创建客户端时才导入，见get_client
+import asyncio
+import functools
+import hashlib
+import heapq
+import itertools
+import threading
+import weakref
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+import random
+import time
 import os
 import statics
+import cache
+import governor
+import tracing
 
 MODEL_FEE = {
     'o1-preview': {
@@ -14,6 +29,7 @@ MODEL_FEE = {
     'gpt-4o': {
         'prompt_fee': 0.0025 * 7,
         'completion_fee': 0.01 * 7,
+        'cached_fee': 0.00125 * 7,
     },
     'gpt-4o-2024-11-20': {
         'prompt_fee': 0.0025 * 7,
@@ -30,6 +46,7 @@ MODEL_FEE = {
     'gpt-4o-mini': {
         'prompt_fee': 0.15/1000 * 7,
         'completion_fee': 0.6/1000 * 7,
+        'cached_fee': 0.075/1000 * 7,
     },
     'gpt-4o-mini-2024-07-18': {
         'prompt_fee': 0.15/1000 * 7,
@@ -118,10 +135,12 @@ MODEL_FEE = {
     'deepseek-chat': {
         'prompt_fee': 2/1000,
         'completion_fee': 8/1000,
+        'cached_fee': 0.5/1000,
     },
     'deepseek-reasoner': {
         'prompt_fee': 4/1000,
         'completion_fee': 16/1000,
+        'cached_fee': 1/1000,
     },
     'deepseek-coder': {
         'prompt_fee': 1/1000,
@@ -170,14 +189,17 @@ MODEL_FEE = {
     'qwen-max': {
         'prompt_fee': 0.02,
         'completion_fee': 0.06,
+        'cached_fee': 0.02 * 0.4,
     },
     'qwen-plus': {
         'prompt_fee': 0.0008,
         'completion_fee': 0.002,
+        'cached_fee': 0.0008 * 0.4,
     },
     'qwen-turbo': {
         'prompt_fee': 0.0003,
         'completion_fee': 0.0006,
+        'cached_fee': 0.0003 * 0.4,
     },
     'qwen-long': {
         'prompt_fee': 0.0005,
@@ -201,84 +223,485 @@ MODEL_FEE = {
     },
 
 }
+# 各模型的上下文窗口（token数），用于budget.ContextBudget
+MODEL_WINDOW = {
+    'o1-preview': 128000,
+    'o1-mini': 128000,
+    'gpt-4o': 128000,
+    'gpt-4o-2024-11-20': 128000,
+    'gpt-4o-2024-08-06': 128000,
+    'gpt-4o-2024-05-13': 128000,
+    'gpt-4o-mini': 128000,
+    'gpt-4o-mini-2024-07-18': 128000,
+    'gpt-4-vision-preview': 128000,
+    'gpt-4-32k': 32768,
+    'gpt-4-turbo': 128000,
+    'gpt-4': 8192,
+    'gpt-3.5-turbo': 16385,
+    'gpt-3.5-0125': 16385,
+    'gpt-3.5-turbo-instruct': 4096,
+    'moonshot-v1-8k': 8192,
+    'moonshot-v1-32k': 32768,
+    'moonshot-v1-128k': 131072,
+    'yi-lightning': 16384,
+    'yi-large': 32768,
+    'yi-medium': 16384,
+    'yi-vision': 16384,
+    'yi-medium-200k': 200000,
+    'yi-spark': 16384,
+    'yi-large-rag': 16384,
+    'yi-large-fc': 32768,
+    'yi-large-turbo': 16384,
+    'deepseek-chat': 65536,
+    'deepseek-reasoner': 65536,
+    'deepseek-coder': 65536,
+    'step-1-8k': 8192,
+    'step-1-32k': 32768,
+    'step-1-128k': 131072,
+    'step-1-256k': 262144,
+    'step-1-flash': 8192,
+    'step-2-16k': 16384,
+    'step-1v-8k': 8192,
+    'step-1v-32k': 32768,
+    'step-1.5v-mini': 32768,
+    'grok-beta': 131072,
+    'qwen-max': 32768,
+    'qwen-plus': 131072,
+    'qwen-turbo': 131072,
+    'qwen-long': 1000000,
+    'qwen2.5-72b-instruct': 131072,
+    'qwen2.5-32b-instruct': 131072,
+    'qwen2.5-14b-instruct': 131072,
+    'qwen2.5-7b-instruct': 131072,
+}
+
+# 连接池配置，修改后对之后新建的客户端生效
+CLIENT_CONFIG = {
+    'max_connections': 100,
+    'max_keepalive_connections': 20,
+    'keepalive_expiry': 60,
+    'timeout': 600,
+    'connect_timeout': 10,
+}
 
+# 每个Request只保留最近的若干个返回，用量通过计数器累计
+RESPONSE_HISTORY = 32
 
-class Request:
-    def __init__(self, server="knowbox", model='', port=9091):
+# 默认的结果缓存，设置为cache.ResponseCache后所有未单独指定缓存的Request都会使用
+RESPONSE_CACHE = None
+
+# 合并同时进行的相同请求，设置为None时不合并；只合并明确传入temperature=0的请求，其余的每次结果可能不同
+SINGLE_FLIGHT = cache.SingleFlight()
+
+# 重试与对冲请求的默认配置
+# backoff是第一次重试前的等待秒数，之后指数增长并加入随机抖动，不超过max_backoff
+# 开启hedge后，请求耗时超过最近hedge_percentile分位的耗时时，会向fallback（没有时向同一个server）再发一次，取先返回的
+RETRY_CONFIG = {
+    'max_retries': 3,
+    'backoff': 0.5,
+    'max_backoff': 20,
+    'hedge_percentile': 0.95,
+    'hedge_min_samples': 20,
+}
+
+
+@functools.cache
+def retryable_errors():
+    """可以重试的错误：超时、连接失败、限流和服务端错误"""
+    import openai
+    return (openai.APITimeoutError, openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError)
+
+
+# 对冲请求（只有备用的那个）在这个线程池中发出，原请求在调用线程中进行
+_hedge_pool = ThreadPoolExecutor(max_workers=32, thread_name_prefix='hedge')
+
+
+class HedgeTimer:
+    """用一个后台线程在到期时触发对冲请求，不为每次请求单独占用一个线程等待"""
+    def __init__(self):
+        self.heap = []
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def schedule(self, delay, func):
+        """delay秒后在后台线程调用func，返回可以传给cancel的句柄"""
+        entry = [time.monotonic() + delay, next(self.counter), func]
+        with self.condition:
+            heapq.heappush(self.heap, entry)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True, name='hedge-timer')
+                self.thread.start()
+            self.condition.notify()
+        return entry
+
+    @staticmethod
+    def cancel(entry):
+        entry[2] = None
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.heap or self.heap[0][0] > time.monotonic():
+                    self.condition.wait(self.heap[0][0] - time.monotonic() if self.heap else None)
+                func = heapq.heappop(self.heap)[2]
+            if func is not None:
+                try:
+                    func()
+                except Exception:
+                    pass
+
+
+_hedge_timer = HedgeTimer()
+
+_clients = {}
+# 异步客户端的连接绑定在事件循环上，按循环分别保存，循环被回收时一起释放
+_async_clients = weakref.WeakKeyDictionary()
+_clients_lock = threading.Lock()
+
+
+def configure_clients(**config):
+    """修改连接池大小和超时，已经创建的客户端会被关闭重建"""
+    CLIENT_CONFIG.update(config)
+    close_clients()
+
+
+def get_client(server, key, base='', is_async=False):
+    """
+    同一个(server, base, key)在进程内共用一个长连接的客户端，避免每个Request重新握手
+    异步客户端的连接绑定在事件循环上，所以每个事件循环各有一个，循环结束（asyncio.run返回）时关闭
+    """
+    client_key = (server, base, key)
+    if is_async:
+        loop = asyncio.get_running_loop()
+        with _clients_lock:
+            # 没有经过shutdown_asyncgens就关闭的循环，客户端已经无法关闭，只释放引用
+            for closed in [item for item in _async_clients if item.is_closed()]:
+                del _async_clients[closed]
+            entry = _async_clients.get(loop)
+            if entry is None:
+                entry = _async_clients[loop] = {'clients': {}, 'retired': [], 'closer': None}
+            client = entry['clients'].get(client_key)
+            if client is None:
+                client = entry['clients'][client_key] = create_client(key, base, is_async=True)
+            if entry['closer'] is None:
+                entry['closer'] = close_on_shutdown(entry)
+        return client
+
+    with _clients_lock:
+        client = _clients.get(client_key)
+        if client is None:
+            client = _clients[client_key] = create_client(key, base)
+    return client
+
+
+def create_client(key, base='', is_async=False):
+    import httpx
+    from openai import OpenAI, AsyncOpenAI
+    limits = httpx.Limits(max_connections=CLIENT_CONFIG['max_connections'],
+                          max_keepalive_connections=CLIENT_CONFIG['max_keepalive_connections'],
+                          keepalive_expiry=CLIENT_CONFIG['keepalive_expiry'])
+    timeout = httpx.Timeout(CLIENT_CONFIG['timeout'], connect=CLIENT_CONFIG['connect_timeout'])
+    # 重试由Request.send控制，不使用SDK自带的重试
+    params = {'api_key': key, 'timeout': timeout, 'max_retries': 0}
+    if base:
+        params['base_url'] = base
+    if is_async:
+        return AsyncOpenAI(http_client=httpx.AsyncClient(limits=limits, timeout=timeout), **params)
+    return OpenAI(http_client=httpx.Client(limits=limits, timeout=timeout), **params)
+
+
+def close_on_shutdown(entry):
+    """
+    在当前事件循环中挂起一个异步生成器，事件循环关闭前（shutdown_asyncgens）会结束它，这时关闭entry中的客户端
+    返回生成器，调用方需要保留引用
+    """
+    async def closer():
+        try:
+            yield
+        finally:
+            clients = list(entry['clients'].values()) + entry['retired']
+            entry['clients'].clear()
+            entry['retired'].clear()
+            # 生成器引用着事件循环，结束后不再保留，循环可以被回收
+            entry['closer'] = None
+            for client in clients:
+                try:
+                    await client.close()
+                except Exception:
+                    pass
+
+    generator = closer()
+    try:
+        # 生成器没有await，第一次send就会停在yield，同时被登记到当前事件循环
+        generator.asend(None).send(None)
+    except StopIteration:
+        pass
+    return generator
+
+
+def close_clients():
+    with _clients_lock:
+        clients = list(_clients.values())
+        _clients.clear()
+        # 异步客户端只能在创建它的事件循环里关闭，这里只停止复用，连接在事件循环结束时关闭
+        for entry in _async_clients.values():
+            entry['retired'].extend(entry['clients'].values())
+            entry['clients'].clear()
+    for client in clients:
+        client.close()
+
+
+def warm_up(*servers, background=True):
+    """
+    提前导入openai SDK并创建servers的客户端，让第一次请求不用等待
+    background为True时在后台线程进行并返回线程，界面可以先显示出来
+    """
+    def run():
+        import openai
+        for server in servers:
+            try:
+                Request(server).client
+            except Exception:
+                # 缺少api key等错误在真正请求时再报告
+                pass
+
+    if not background:
+        run()
+        return None
+    thread = threading.Thread(target=run, daemon=True, name='warm-up')
+    thread.start()
+    return thread
+
+
+def resolve_server(server, model='', port=9091):
+    """返回server对应的(model, key, base, limits)，model为空时使用该server的默认模型"""
+    base = ''
+    # limits是该server的限流配置：每分钟请求数rpm、每分钟token数tpm、并发数concurrency
+    limits = {}
+    match server:
+        case 'jieyue' | 'step':
+            limits = {'rpm': 60, 'tpm': 1000000, 'concurrency': 10}
+            key = os.environ.get('JIEYUE_API_KEY')
+            base = 'https://api.step.ai/v1'
+            base = "https://api.stepfun.com/v1"
+            if model == "":
+                model = "step-1-flash"
+        case 'ali' | 'qwen':
+            limits = {'rpm': 1200, 'tpm': 1000000, 'concurrency': 50}
+            key = os.environ.get('QWEN_API_KEY')
+            base = 'https://dashscope.aliyuncs.com/compatible-mode/v1'
+            if model == '':
+                model = 'qwen-turbo'
+        case 'grok':
+            limits = {'rpm': 60, 'tpm': 100000, 'concurrency': 10}
+            key = os.environ.get('GROK_API_KEY')
+            base = 'https://api.x.ai/v1'
+            if model == '':
+                model="grok-beta"
+        case 'tmove':
+            limits = {'concurrency': 10}
+            key = os.environ.get('TMOVE_KEY')
+            if model == '':
+                model = "gpt-3.5-turbo"
+        case 'tmove_r':
+            limits = {'concurrency': 10}
+            key = os.environ.get('TMOVE_R_KEY')
+            if model == '':
+                model = "gpt-3.5-turbo"
+        case 'knowbox':
+            limits = {'concurrency': 10}
+            key = os.environ.get('KNOWBOX_KEY')
+            base = "https://maxsj166proxy.xyz/v1"
+            if model == '':
+                model = "gpt-3.5-turbo"
+        case 'moonshot' | 'kimi':
+            limits = {'rpm': 200, 'tpm': 128000, 'concurrency': 50}
+            key = os.environ.get('KIMI_API_KEY')
+            base = "https://api.moonshot.cn/v1"
+            if model == '':
+                model = "moonshot-v1-8k"
+        case 'yi':
+            limits = {'rpm': 60, 'tpm': 100000, 'concurrency': 10}
+            key = os.environ.get('LINGYI_API_KEY')
+            base = "https://api.lingyiwanwu.com/v1"
+            if model == '':
+                model = "yi-medium"
+        case 'deepseek':
+            limits = {'concurrency': 50}
+            key = os.environ.get('DEEPSEEK_API_KEY')
+            base = 'https://api.deepseek.com'
+            if model == '':
+                model = "deepseek-chat"
+        case 'private_deepseek':
+            limits = {'concurrency': 2}
+            key = os.environ.get('HUANG_KEY')
+            base = 'http://121.225.97.127:18981/api/v1'
+            model = "DeepSeek-R1-Q4_K_M"
+        case 'mock':
+            # 本地的模拟服务，见mock_server.py，port是它监听的端口，也可以用MOCK_BASE_URL指定地址
+            key = os.environ.get('MOCK_API_KEY', 'mock')
+            base = os.environ.get('MOCK_BASE_URL', f'http://127.0.0.1:{port}/v1')
+            if model == '':
+                model = 'mock'
+        case 'tunnel':
+            limits = {'concurrency': 10}
+            base = 'https://api.nuwaapi.com/v1'
+            key = os.environ.get('TUNNEL_KEY')
+        case _:
+            limits = {'rpm': 500, 'tpm': 200000, 'concurrency': 50}
+            key = os.environ.get('OPENAI_API_KEY')
+    return model, key, base, limits
+
+
+def provider_key(server, port=9091):
+    """server对应的限流器的key，见limiter_key"""
+    _, key, base, _ = resolve_server(server, port=port)
+    return limiter_key(base, key)
+
+
+def limiter_key(base, key):
+    """
+    同一个服务商账号（base_url和api key相同）共用一个限流器，'ali'和'qwen'这样的别名不会各算一份额度
+    没有base的server使用openai的默认地址，key中只保存api key的hash
+    """
+    digest = hashlib.sha256((key or '').encode('utf-8')).hexdigest()[:12]
+    return f"{base or 'openai'}#{digest}"
+
+
+class StreamInterrupted(Exception):
+    """流式返回已经把部分内容交给on_delta后中断，不再重试，避免回调收到重复的内容"""
+
+
+class StreamCollector:
+    """把流式返回的chunk拼装成完整的ChatCompletion，tool_call按index拼接"""
+    def __init__(self, model, on_delta=None, start=None):
         self.model = model
-        base = ''
-        match server:
-            case 'jieyue' | 'step':
-                key = os.environ.get('JIEYUE_API_KEY')
-                base = 'https://api.step.ai/v1'
-                base = "https://api.stepfun.com/v1"
-                if self.model == "":
-                    self.model = "step-1-flash"
-            case 'ali' | 'qwen':
-                key = os.environ.get('QWEN_API_KEY')
-                base = 'https://dashscope.aliyuncs.com/compatible-mode/v1'
-                if self.model == '':
-                    self.model = 'qwen-turbo'
-            case 'grok':
-                key = os.environ.get('GROK_API_KEY')
-                base = 'https://api.x.ai/v1'
-                if self.model == '':
-                    self.model="grok-beta"
-            case 'tmove':
-                key = os.environ.get('TMOVE_KEY')
-                if self.model == '':
-                    self.model = "gpt-3.5-turbo"
-            case 'tmove_r':
-                key = os.environ.get('TMOVE_R_KEY')
-                if self.model == '':
-                    self.model = "gpt-3.5-turbo"
-            case 'knowbox':
-                key = os.environ.get('KNOWBOX_KEY')
-                base = "https://maxsj166proxy.xyz/v1"
-                if self.model == '':
-                    self.model = "gpt-3.5-turbo"
-            case 'moonshot' | 'kimi':
-                key = os.environ.get('KIMI_API_KEY')
-                base = "https://api.moonshot.cn/v1"
-                if self.model == '':
-                    self.model = "moonshot-v1-8k"
-            case 'yi':
-                key = os.environ.get('LINGYI_API_KEY')
-                base = "https://api.lingyiwanwu.com/v1"
-                if self.model == '':
-                    self.model = "yi-medium"
-            case 'deepseek':
-                key = os.environ.get('DEEPSEEK_API_KEY')
-                base = 'https://api.deepseek.com'
-                if self.model == '':
-                    self.model = "deepseek-chat"
-            case 'private_deepseek':
-                key = os.environ.get('HUANG_KEY')
-                base = 'http://121.225.97.127:18981/api/v1'
-                self.model = "DeepSeek-R1-Q4_K_M"
-            case 'tunnel':
-                base = 'https://api.nuwaapi.com/v1'
-                key = os.environ.get('TUNNEL_KEY')
-            case _:
-                key = os.environ.get('OPENAI_API_KEY')
-
-        if base:
-            self.client = OpenAI(
-            api_key=key,
-            base_url=base
-        )
-        else:
-            self.client = OpenAI(
-            api_key=key,
-        )
+        self.on_delta = on_delta
+        # start是发出请求的时间，用来计算首token时间
+        self.start = start or time.time()
+        self.ttft = None
+        self.response_id = ''
+        self.created = int(self.start)
+        self.content = []
+        self.tool_calls = {}
+        self.finish_reason = None
+        self.usage = None
+        # 是否已经有内容交给了on_delta
+        self.emitted = False
+
+    def add(self, chunk):
+        self.response_id = chunk.id or self.response_id
+        self.created = chunk.created or self.created
+        self.model = chunk.model or self.model
+        if chunk.usage:
+            # stream_options.include_usage时最后一个chunk带有用量，choices为空
+            self.usage = chunk.usage
+        if not chunk.choices:
+            return
+        choice = chunk.choices[0]
+        delta = choice.delta
+        if self.ttft is None and (delta.content or delta.tool_calls):
+            self.ttft = time.time() - self.start
+        if delta.content:
+            self.content.append(delta.content)
+            if callable(self.on_delta):
+                self.emitted = True
+                self.on_delta(delta.content)
+        for tool_call in delta.tool_calls or []:
+            slot = self.tool_calls.setdefault(tool_call.index, {
+                'id': '',
+                'type': 'function',
+                'function': {'name': '', 'arguments': ''},
+            })
+            if tool_call.id:
+                slot['id'] = tool_call.id
+            if tool_call.function:
+                if tool_call.function.name:
+                    slot['function']['name'] += tool_call.function.name
+                if tool_call.function.arguments:
+                    slot['function']['arguments'] += tool_call.function.arguments
+        if choice.finish_reason:
+            self.finish_reason = choice.finish_reason
+
+    def completion(self):
+        message = {'role': 'assistant', 'content': ''.join(self.content) or None}
+        if self.tool_calls:
+            message['tool_calls'] = [self.tool_calls[index] for index in sorted(self.tool_calls)]
+        response = {
+            'id': self.response_id,
+            'object': 'chat.completion',
+            'created': self.created,
+            'model': self.model,
+            'choices': [{
+                'index': 0,
+                'finish_reason': self.finish_reason or ('tool_calls' if self.tool_calls else 'stop'),
+                'message': message,
+            }],
+        }
+        if self.usage:
+            response['usage'] = self.usage.model_dump()
+        from openai.types.chat import ChatCompletion
+        return ChatCompletion.model_validate(response)
+
+
+class Request:
+    def __init__(self, server="knowbox", model='', port=9091, history=RESPONSE_HISTORY, response_cache=None,
+                 timeout=0, max_retries=None, hedge=False, fallback=None):
+        """
+        timeout是一次call的总时限（包括重试），为0时不限制
+        hedge为True时开启对冲请求，fallback是对冲请求使用的server名或Request
+        """
+        self.model, key, base, limits = resolve_server(server, model, port)
+        self.server = server
+        self._key = key
+        self._base = base
+        # 同一个服务商账号在进程内共用一个限流器
+        self.limiter = governor.get_limiter(limiter_key(base, key), limits)
+
+        # response_list是定长的环形缓冲，read_response只能读取最近history个返回
+        self.response_list = deque(maxlen=history)
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        # prompt_tokens中命中服务端上下文缓存的部分
+        self.cached_tokens = 0
+        self._usage_lock = threading.Lock()
+        # 流式返回的首token时间（秒）
+        self.ttft_list = deque(maxlen=history)
+        # 为None时使用RESPONSE_CACHE，为False时不使用缓存
+        self.response_cache = response_cache
+
+        self.timeout = timeout
+        self.max_retries = RETRY_CONFIG['max_retries'] if max_retries is None else max_retries
+        self.hedge = hedge
+        self.fallback = Request(fallback, timeout=timeout) if isinstance(fallback, str) else fallback
+        # 成功请求的耗时，用来计算对冲请求的触发时间
+        self.latency_list = deque(maxlen=max(history, RETRY_CONFIG['hedge_min_samples']))
+        self.call_stats = {
+            'calls': 0,
+            'successes': 0,
+            'failures': 0,
+            'retries': 0,
+            'hedges': 0,
+            'hedge_wins': 0,
+            'coalesced': 0,
+        }
 
-        self.response_list = []
+    @property
+    def client(self):
+        # 客户端（以及openai SDK）在第一次请求时才创建
+        return get_client(self.server, self._key, self._base)
+
+    @property
+    def async_client(self):
+        # 异步客户端在第一次调用acall时才创建
+        return get_client(self.server, self._key, self._base, is_async=True)
 
     def define_tools(self, tools: list):
         tool_list = statics.define_tools(self, tools)
         return {'tools': tool_list}
 
-    def call(self, messages, **kwargs):
+    def build_params(self, messages, **kwargs):
         if 'vision' or 'gpt-4o' not in self.model:
             messages = statics.remove_no_str_message(messages)
         else:
@@ -314,10 +737,363 @@ class Request:
         if 'response_format' in kwargs.keys():
             if kwargs['response_format']== 'json':
                 params['response_format'] = {"type": "json_object"}
+
+        if kwargs.get('stream'):
+            params['stream'] = True
+            params['stream_options'] = {'include_usage': True}
         
-        response = self.client.chat.completions.create(**params)
+        return params
+
+    def call(self, messages, **kwargs):
+        """stream=True时流式接收，每段新内容会传给on_delta回调，结束后拼装为完整返回"""
+        with tracing.span('Request.call', server=self.server, model=self.model,
+                          stream=bool(kwargs.get('stream'))) as span:
+            params = self.build_params(messages, **kwargs)
+            response_cache, key = self.cache_key(params, kwargs)
+            if key and (response := self.read_cache(response_cache, key, kwargs)):
+                self.record_response(response)
+                span.set('cache_hit', True)
+                return self
+            retries = self.call_stats['retries']
+            response, coalesced = self.flight(params, kwargs)
+            if coalesced:
+                # 合并到了同时进行的相同请求，用量已经计在发出请求的Request上
+                self.record_response(response)
+                span.set('coalesced', True)
+                return self
+            if key:
+                response_cache.set(key, response.model_dump_json())
+            self.record_response(response)
+            self.trace_response(span, response, retries)
+            return self
+
+    async def acall(self, messages, **kwargs):
+        """call的异步版本，共用同一个response_list，可以在一个事件循环中同时发出大量请求"""
+        with tracing.span('Request.call', server=self.server, model=self.model,
+                          stream=bool(kwargs.get('stream'))) as span:
+            params = self.build_params(messages, **kwargs)
+            response_cache, key = self.cache_key(params, kwargs)
+            if key and (response := self.read_cache(response_cache, key, kwargs)):
+                self.record_response(response)
+                span.set('cache_hit', True)
+                return self
+            retries = self.call_stats['retries']
+            response, coalesced = await self.aflight(params, kwargs)
+            if coalesced:
+                # 合并到了同时进行的相同请求，用量已经计在发出请求的Request上
+                self.record_response(response)
+                span.set('coalesced', True)
+                return self
+            if key:
+                response_cache.set(key, response.model_dump_json())
+            self.record_response(response)
+            self.trace_response(span, response, retries)
+            return self
+
+    def trace_response(self, span, response, retries):
+        """把用量、重试次数和首token时间记录到span，没有开启追踪时直接返回"""
+        if span is tracing.NOOP_SPAN:
+            return
+        usage = getattr(response, 'usage', None)
+        span.update(cache_hit=False, retries=self.call_stats['retries'] - retries)
+        if usage:
+            span.update(prompt_tokens=usage.prompt_tokens, completion_tokens=usage.completion_tokens,
+                        cached_tokens=self.read_cached_tokens(usage))
+        if span.attributes['stream'] and self.ttft_list:
+            span.set('ttft', self.ttft_list[-1])
+
+    def flight_key(self, params, kwargs):
+        """合并请求使用的key，不合并时返回None；调用时传入coalesce=False可以跳过合并"""
+        if not SINGLE_FLIGHT or not kwargs.get('coalesce', True) or params.get('temperature') != 0:
+            return None
+        return f'{self.server}:{cache.request_key(params)}'
+
+    def flight(self, params, kwargs):
+        """返回(ChatCompletion, 是否合并到了其他请求)"""
+        key = self.flight_key(params, kwargs)
+        if key is None:
+            return self.send(params, kwargs), False
+        # 等待其他请求时同样受本Request的总时限约束
+        timeout = self.timeout or None
+        response, coalesced = SINGLE_FLIGHT.do(key, lambda: self.send(params, kwargs), timeout)
+        if coalesced:
+            self.count_call('coalesced')
+            self.replay_delta(response, kwargs)
+        return response, coalesced
+
+    async def aflight(self, params, kwargs):
+        key = self.flight_key(params, kwargs)
+        if key is None:
+            return await self.asend(params, kwargs), False
+        timeout = self.timeout or None
+        response, coalesced = await SINGLE_FLIGHT.ado(key, lambda: self.asend(params, kwargs), timeout)
+        if coalesced:
+            self.count_call('coalesced')
+            self.replay_delta(response, kwargs)
+        return response, coalesced
+
+    def send(self, params, kwargs):
+        """
+        向服务器发出请求，返回完整的ChatCompletion
+        可重试的错误按指数退避重试，超过总时限或重试次数后抛出最后一次的错误
+        """
+        self.count_call('calls')
+        deadline = time.time() + self.timeout if self.timeout else None
+        retry = 0
+        while True:
+            try:
+                response = self.hedged(params, kwargs, self.remaining(deadline))
+                self.count_call('successes')
+                return response
+            except retryable_errors():
+                delay = self.backoff(retry)
+                if retry >= self.max_retries or (deadline and time.time() + delay >= deadline):
+                    self.count_call('failures')
+                    raise
+                retry += 1
+                self.count_call('retries')
+                time.sleep(delay)
+            except Exception:
+                self.count_call('failures')
+                raise
+
+    async def asend(self, params, kwargs):
+        self.count_call('calls')
+        deadline = time.time() + self.timeout if self.timeout else None
+        retry = 0
+        while True:
+            try:
+                response = await self.ahedged(params, kwargs, self.remaining(deadline))
+                self.count_call('successes')
+                return response
+            except retryable_errors():
+                delay = self.backoff(retry)
+                if retry >= self.max_retries or (deadline and time.time() + delay >= deadline):
+                    self.count_call('failures')
+                    raise
+                retry += 1
+                self.count_call('retries')
+                await asyncio.sleep(delay)
+            except Exception:
+                self.count_call('failures')
+                raise
+
+    @staticmethod
+    def remaining(deadline):
+        if deadline is None:
+            return None
+        return max(deadline - time.time(), 0.001)
+
+    @staticmethod
+    def backoff(retry):
+        ceiling = min(RETRY_CONFIG['max_backoff'], RETRY_CONFIG['backoff'] * 2 ** retry)
+        return random.uniform(ceiling / 2, ceiling)
+
+    def hedge_delay(self):
+        """返回触发对冲请求前等待的秒数，样本不足或未开启时返回None"""
+        if not self.hedge or len(self.latency_list) < RETRY_CONFIG['hedge_min_samples']:
+            return None
+        latencies = sorted(self.latency_list)
+        return latencies[min(int(len(latencies) * RETRY_CONFIG['hedge_percentile']), len(latencies) - 1)]
+
+    def hedge_request(self, params):
+        """对冲请求使用的Request和参数"""
+        backup = self.fallback or self
+        return backup, dict(params, model=backup.model)
+
+    def hedged(self, params, kwargs, timeout):
+        """
+        原请求在调用线程中进行，超过hedge_delay还没有返回时，在_hedge_pool中向fallback再发一次
+        同步请求无法中途放弃，原请求成功时取原请求的结果，失败时（如超时）改用对冲请求的结果
+        """
+        delay = self.hedge_delay()
+        # 流式请求的内容已经交给回调，不能再对冲
+        if delay is None or params.get('stream'):
+            return self.attempt(params, kwargs, timeout)
+
+        lock = threading.Lock()
+        state = SimpleNamespace(finished=False, backup=None)
+
+        def launch():
+            with lock:
+                if state.finished:
+                    return
+                self.count_call('hedges')
+                backup_request, backup_params = self.hedge_request(params)
+                state.backup = _hedge_pool.submit(tracing.wrap(backup_request.attempt), backup_params, kwargs, timeout)
+
+        timer = _hedge_timer.schedule(delay, launch)
+        try:
+            response = self.attempt(params, kwargs, timeout)
+        except Exception as e:
+            error = e
+            response = None
+        _hedge_timer.cancel(timer)
+        with lock:
+            state.finished = True
+            backup = state.backup
+        if response is not None:
+            # 还在排队的对冲请求取消，已经发出的在attempt中把用量计在各自的Request上
+            if backup is not None:
+                backup.cancel()
+            return response
+        if backup is None:
+            raise error
+        try:
+            response = backup.result()
+        except Exception:
+            # 两个请求都失败时抛出原请求的错误
+            raise error
+        self.count_call('hedge_wins')
+        return response
+
+    async def ahedged(self, params, kwargs, timeout):
+        delay = self.hedge_delay()
+        if delay is None or params.get('stream'):
+            return await self.aattempt(params, kwargs, timeout)
+
+        primary = asyncio.ensure_future(self.aattempt(params, kwargs, timeout))
+        done, _ = await asyncio.wait([primary], timeout=delay)
+        if done:
+            return primary.result()
+
+        self.count_call('hedges')
+        backup_request, backup_params = self.hedge_request(params)
+        backup = asyncio.ensure_future(backup_request.aattempt(backup_params, kwargs, timeout))
+        pending = {primary, backup}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    if future.exception() is None:
+                        if future is backup:
+                            self.count_call('hedge_wins')
+                        return future.result()
+            return primary.result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+    @staticmethod
+    def timeout_option(timeout):
+        """没有时限时不传timeout，使用客户端的默认值"""
+        return {'timeout': timeout} if timeout else {}
+
+    def attempt(self, params, kwargs, timeout=None):
+        """发出一次请求，超出server的限流时排队等待"""
+        tokens = governor.estimate_tokens(params)
+        with tracing.span('Request.queue', server=self.server):
+            self.limiter.acquire(tokens)
+        response = None
+        try:
+            start = time.time()
+            with tracing.span('Request.network', server=self.server, model=params.get('model')):
+                response = self.client.chat.completions.create(**params, **self.timeout_option(timeout))
+                if params.get('stream'):
+                    collector = StreamCollector(self.model, kwargs.get('on_delta'), start)
+                    try:
+                        for chunk in response:
+                            collector.add(chunk)
+                    except Exception as e:
+                        self.check_stream(collector, e)
+                        raise
+                    response = self.finish_stream(collector)
+            self.latency_list.append(time.time() - start)
+            self.record_usage(response)
+            return response
+        finally:
+            self.limiter.release(tokens, self.used_tokens(response))
+
+    async def aattempt(self, params, kwargs, timeout=None):
+        tokens = governor.estimate_tokens(params)
+        with tracing.span('Request.queue', server=self.server):
+            await self.limiter.aacquire(tokens)
+        response = None
+        try:
+            start = time.time()
+            with tracing.span('Request.network', server=self.server, model=params.get('model')):
+                response = await self.async_client.chat.completions.create(**params, **self.timeout_option(timeout))
+                if params.get('stream'):
+                    collector = StreamCollector(self.model, kwargs.get('on_delta'), start)
+                    try:
+                        async for chunk in response:
+                            collector.add(chunk)
+                    except Exception as e:
+                        self.check_stream(collector, e)
+                        raise
+                    response = self.finish_stream(collector)
+            self.latency_list.append(time.time() - start)
+            self.record_usage(response)
+            return response
+        finally:
+            self.limiter.release(tokens, self.used_tokens(response))
+
+    @staticmethod
+    def used_tokens(response):
+        usage = getattr(response, 'usage', None)
+        return usage.total_tokens if usage else None
+
+    @staticmethod
+    def check_stream(collector, error):
+        """流式返回中断时，已经有内容交给回调的不能重试"""
+        if collector.emitted:
+            raise StreamInterrupted(f'流式返回在输出部分内容后中断：{type(error).__name__}: {error}') from error
+
+    def finish_stream(self, collector):
+        if collector.ttft is not None:
+            self.ttft_list.append(collector.ttft)
+        return collector.completion()
+
+    def cache_key(self, params, kwargs):
+        """返回本次请求使用的缓存和key，不使用缓存时key为None；调用时传入use_cache=False可以跳过缓存"""
+        response_cache = RESPONSE_CACHE if self.response_cache is None else self.response_cache
+        if not response_cache or not kwargs.get('use_cache', True) or not response_cache.cacheable(params):
+            return None, None
+        # 同一个服务商的不同别名（如ali和qwen）地址相同，共用缓存
+        return response_cache, cache.request_key(params, self._base or self.server)
+
+    @staticmethod
+    def read_cache(response_cache, key, kwargs):
+        value = response_cache.get(key)
+        if value is None:
+            return None
+        from openai.types.chat import ChatCompletion
+        response = ChatCompletion.model_validate_json(value)
+        Request.replay_delta(response, kwargs)
+        return response
+
+    @staticmethod
+    def replay_delta(response, kwargs):
+        """命中缓存或合并请求时没有流式过程，把完整内容一次性交给流式回调"""
+        content = response.choices[0].message.content
+        if kwargs.get('stream') and content and callable(kwargs.get('on_delta')):
+            kwargs['on_delta'](content)
+
+    def record_response(self, response):
+        """保存返回；用量在attempt中计入实际发出请求的Request，命中缓存和合并的返回不重复计算"""
         self.response_list.append(response)
-        return self
+
+    def count_call(self, name):
+        with self._usage_lock:
+            self.call_stats[name] += 1
+
+    def record_usage(self, response):
+        """累计一次实际请求的token用量，对冲请求中后返回的那个也会计入"""
+        usage = getattr(response, 'usage', None)
+        if usage:
+            with self._usage_lock:
+                self.prompt_tokens += usage.prompt_tokens or 0
+                self.completion_tokens += usage.completion_tokens or 0
+                self.cached_tokens += self.read_cached_tokens(usage)
+
+    @staticmethod
+    def read_cached_tokens(usage):
+        """命中上下文缓存的prompt token数：openai、qwen在prompt_tokens_details.cached_tokens，deepseek在prompt_cache_hit_tokens"""
+        details = getattr(usage, 'prompt_tokens_details', None)
+        cached = getattr(details, 'cached_tokens', None) if details else None
+        if cached is None:
+            cached = getattr(usage, 'prompt_cache_hit_tokens', None)
+        return cached or 0
 
     def read_response(self, position=-1):
         try:
@@ -337,7 +1113,7 @@ class Request:
 
         return statics.read_response(completed_message.role,
                                      record_message,
-                                     call_message)
+                                     tool_calls=call_message)
 
     def dump_tool_call_msg(self, tool_msg='', position=-1):
         return {"role": "tool",
@@ -345,10 +1121,8 @@ class Request:
                 "tool_call_id": self.response_list[position].choices[0].message.tool_calls[0].id
                 }
 
-    def count_usage(self):
-        prompt_tokens = 0
-        completion_tokens = 0
-        model_set = ''
+    def fee_model(self):
+        """MODEL_FEE中对应的模型名"""
         if self.model in \
                 ['gpt-4-0125-preview', 'gpt-4-turbo-preview', 'gpt-4-1106-preview', 'gpt-4-vision-preview',
                  'gpt-4-vision-1106-preview',]:
@@ -363,16 +1137,28 @@ class Request:
             model_set = 'gpt-3.5-turbo'
         else:
             model_set = self.model
+        return model_set
 
-        for response in self.response_list:
-            try:
-                usage = response.usage
-                prompt_tokens += usage.prompt_tokens
-                completion_tokens += usage.completion_tokens
-            except Exception:
-                continue
+    def fee(self):
+        """到目前为止的费用（包括fallback上的对冲请求），没有价格的模型返回None"""
+        fee = statics.compute_fee(self.fee_model(), MODEL_FEE, self.prompt_tokens, self.completion_tokens,
+                                  self.cached_tokens)
+        if self.fallback and (self.fallback.prompt_tokens or self.fallback.completion_tokens) and fee is not None:
+            fallback_fee = self.fallback.fee()
+            fee = None if fallback_fee is None else fee + fallback_fee
+        return fee
 
-        statics.tokens2fee(model_set, MODEL_FEE, prompt_tokens, completion_tokens)
+    def count_usage(self):
+        statics.tokens2fee(self.fee_model(), MODEL_FEE, self.prompt_tokens, self.completion_tokens,
+                           self.cached_tokens)
+        if self.ttft_list:
+            print(f'avg_ttft: {sum(self.ttft_list) / len(self.ttft_list):.3f}s')
+        if self.call_stats['retries'] or self.call_stats['hedges'] or self.call_stats['failures'] \
+                or self.call_stats['coalesced']:
+            print(f"calls: {self.call_stats}")
+        if self.fallback and self.fallback.prompt_tokens:
+            print(f'fallback {self.fallback.server}/{self.fallback.model}:')
+            self.fallback.count_usage()
 
 
 if __name__ == '__main__':
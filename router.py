@@ -0,0 +1,284 @@
+# 在多个服务商之间路由请求：按请求类别（提取、总结、对话）从候选的server/model中选择一个
+# 根据最近的延迟（EWMA）、错误率、MODEL_FEE中的价格和限流器的剩余额度打分，请求失败时自动换下一个
+# 在Task/Talk中使用时，server写'router'，model写请求类别，如{'name': 'extractor', 'server': 'router', 'model': 'extraction'}
+from collections import deque
+import functools
+import threading
+import time
+import governor
+import paradigm
+import statics
+import tracing
+
+# 每个请求类别的候选（server, model），以及打分时各项的权重，server使用和EXTRACT_SERVICE等相同的名字
+# latency、cost、error、headroom分别对应延迟、费用、错误率和限流额度不足的惩罚
+ROUTES = {
+    'extraction': {
+        'candidates': [('qwen', 'qwen-plus'), ('deepseek', 'deepseek-chat'), ('moonshot', 'moonshot-v1-32k')],
+        'weights': {'latency': 0.2, 'cost': 0.4, 'error': 1.0, 'headroom': 0.4},
+    },
+    'summarization': {
+        'candidates': [('qwen', 'qwen-turbo'), ('deepseek', 'deepseek-chat'), ('qwen', 'qwen-plus'),
+                       ('moonshot', 'moonshot-v1-8k')],
+        'weights': {'latency': 0.3, 'cost': 0.5, 'error': 1.0, 'headroom': 0.4},
+    },
+    'chat': {
+        'candidates': [('qwen', 'qwen-plus'), ('deepseek', 'deepseek-chat'), ('qwen', 'qwen-turbo'),
+                       ('moonshot', 'moonshot-v1-8k')],
+        'weights': {'latency': 0.6, 'cost': 0.2, 'error': 1.0, 'headroom': 0.4},
+    },
+}
+
+# alpha是EWMA的平滑系数，initial_latency是还没有样本时假设的延迟（秒）
+# 连续失败max_failures次后，该服务商在cooldown秒内不参与选择（所有候选都不可用时仍会尝试）
+# 有候选可以换时，每个服务商只重试max_retries次，completion_tokens是估计费用时假设的输出长度
+ROUTER_CONFIG = {
+    'alpha': 0.2,
+    'initial_latency': 2.0,
+    'max_failures': 3,
+    'cooldown': 60,
+    'max_retries': 1,
+    'completion_tokens': 500,
+}
+
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+class ProviderStats:
+    """一个(server, model)的延迟和错误率，进程内所有RouterRequest共用"""
+    def __init__(self):
+        self.latency = None
+        self.error_rate = 0
+        self.calls = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.down_until = 0
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def record_success(self, latency):
+        alpha = ROUTER_CONFIG['alpha']
+        with self.lock:
+            self.calls += 1
+            self.consecutive_failures = 0
+            self.latency = latency if self.latency is None else alpha * latency + (1 - alpha) * self.latency
+            self.error_rate = (1 - alpha) * self.recent_error_rate()
+            self.updated = time.monotonic()
+
+    def record_failure(self):
+        alpha = ROUTER_CONFIG['alpha']
+        with self.lock:
+            self.calls += 1
+            self.failures += 1
+            self.consecutive_failures += 1
+            self.error_rate = alpha + (1 - alpha) * self.recent_error_rate()
+            self.updated = time.monotonic()
+            if self.consecutive_failures >= ROUTER_CONFIG['max_failures']:
+                self.down_until = time.monotonic() + ROUTER_CONFIG['cooldown']
+
+    def recent_error_rate(self):
+        """没有新请求时错误率每过cooldown秒减半，暂时出错的服务商之后还有机会被选中"""
+        return self.error_rate * 0.5 ** ((time.monotonic() - self.updated) / ROUTER_CONFIG['cooldown'])
+
+    def available(self):
+        return time.monotonic() >= self.down_until
+
+    def stats(self):
+        return {
+            'latency': self.latency,
+            'error_rate': self.recent_error_rate(),
+            'calls': self.calls,
+            'failures': self.failures,
+            'available': self.available(),
+        }
+
+
+def get_stats(server, model):
+    with _stats_lock:
+        stats = _stats.get((server, model))
+        if stats is None:
+            stats = ProviderStats()
+            _stats[(server, model)] = stats
+        return stats
+
+
+def route_stats():
+    """所有服务商的统计，key是'server/model'"""
+    with _stats_lock:
+        items = list(_stats.items())
+    return {f'{server}/{model}': stats.stats() for (server, model), stats in items}
+
+
+@functools.cache
+def failover_errors():
+    """换下一个服务商可能成功的错误：可以重试的错误，以及api key无效、没有权限"""
+    import openai
+    return paradigm.retryable_errors() + (openai.AuthenticationError, openai.PermissionDeniedError)
+
+
+def can_failover(error):
+    """
+    请求参数错误等换服务商也不会成功的错误直接抛出
+    流式返回已经输出部分内容后中断（paradigm.StreamInterrupted）也不换，避免回调收到两份内容
+    """
+    import openai
+    # 缺少api key时创建客户端抛出的就是OpenAIError本身
+    return isinstance(error, failover_errors()) or type(error) is openai.OpenAIError
+
+
+def price(model, prompt_tokens, completion_tokens):
+    """按MODEL_FEE估计一次请求的费用，没有价格的模型返回None"""
+    return statics.compute_fee(model, paradigm.MODEL_FEE, prompt_tokens, completion_tokens)
+
+
+class RouterRequest:
+    """
+    和paradigm.Request有相同的调用方式，每次call按打分选择候选中的一个Request发出请求
+    候选的Request在第一次被选中时才创建，缺少api key、超时、限流等错误时换下一个候选，其余错误直接抛出
+    """
+    def __init__(self, route='chat', timeout=0, history=paradigm.RESPONSE_HISTORY):
+        if route not in ROUTES:
+            raise ValueError(f'未知的请求类别：{route}，可选：{list(ROUTES)}')
+        self.route = route
+        self.server = 'router'
+        self.timeout = timeout
+        self.candidates = ROUTES[route]['candidates']
+        self.weights = ROUTES[route]['weights']
+        self.requests = {}
+        # 最近一次使用的服务商，define_tools、预算等按它的model处理
+        self.current = self.candidates[0]
+        self.response_list = deque(maxlen=history)
+        self.call_stats = {'calls': 0, 'failovers': 0, 'failures': 0}
+
+    @property
+    def model(self):
+        return self.current[1]
+
+    @property
+    def prompt_tokens(self):
+        return sum(request.prompt_tokens for request in self.requests.values())
+
+    @property
+    def completion_tokens(self):
+        return sum(request.completion_tokens for request in self.requests.values())
+
+    @property
+    def cached_tokens(self):
+        return sum(request.cached_tokens for request in self.requests.values())
+
+    # 读取返回和工具调用只依赖response_list和model
+    define_tools = paradigm.Request.define_tools
+    read_response = paradigm.Request.read_response
+    dump_tool_call_msg = paradigm.Request.dump_tool_call_msg
+
+    def get_request(self, server, model):
+        request = self.requests.get((server, model))
+        if request is None:
+            request = paradigm.Request(server, model, timeout=self.timeout,
+                                       max_retries=ROUTER_CONFIG['max_retries'])
+            self.requests[(server, model)] = request
+        return request
+
+    def score(self, server, model, latencies, costs):
+        """分数越低越好，延迟和费用按候选中的最大值归一化"""
+        stats = get_stats(server, model)
+        # 限流器按服务商账号共用，其他Service（如提取）在同一账号上的请求也会降低headroom
+        headroom = governor.headroom(paradigm.provider_key(server))
+        score = self.weights['error'] * stats.recent_error_rate() + self.weights['headroom'] * (1 - headroom)
+        latency = latencies[(server, model)]
+        if max(latencies.values()):
+            score += self.weights['latency'] * latency / max(latencies.values())
+        cost = costs[(server, model)]
+        # 没有价格的模型按最贵的算
+        max_cost = max([value for value in costs.values() if value is not None], default=0)
+        if max_cost:
+            score += self.weights['cost'] * (max_cost if cost is None else cost) / max_cost
+        return score
+
+    def rank(self, params):
+        """按分数排列候选，冷却中的服务商放在最后"""
+        tokens = governor.estimate_tokens({'messages': params['messages']})
+        completion_tokens = params.get('max_tokens') or ROUTER_CONFIG['completion_tokens']
+        latencies = {}
+        costs = {}
+        for server, model in self.candidates:
+            latency = get_stats(server, model).latency
+            latencies[(server, model)] = ROUTER_CONFIG['initial_latency'] if latency is None else latency
+            costs[(server, model)] = price(model, tokens, completion_tokens)
+        scores = {candidate: self.score(*candidate, latencies, costs) for candidate in self.candidates}
+        return sorted(self.candidates, key=lambda x: (not get_stats(*x).available(), scores[x]))
+
+    def call(self, messages, **kwargs):
+        with tracing.span('Router.call', route=self.route) as span:
+            self.call_stats['calls'] += 1
+            error = None
+            for i, (server, model) in enumerate(self.rank({'messages': messages, **kwargs})):
+                stats = get_stats(server, model)
+                start = time.time()
+                try:
+                    request = self.get_request(server, model)
+                    request.call(messages, **kwargs)
+                except Exception as e:
+                    if not can_failover(e):
+                        self.call_stats['failures'] += 1
+                        raise
+                    stats.record_failure()
+                    error = e
+                    continue
+                stats.record_success(time.time() - start)
+                self.finish(request, server, model, i, span)
+                return self
+            self.call_stats['failures'] += 1
+            raise error
+
+    async def acall(self, messages, **kwargs):
+        with tracing.span('Router.call', route=self.route) as span:
+            self.call_stats['calls'] += 1
+            error = None
+            for i, (server, model) in enumerate(self.rank({'messages': messages, **kwargs})):
+                stats = get_stats(server, model)
+                start = time.time()
+                try:
+                    request = self.get_request(server, model)
+                    await request.acall(messages, **kwargs)
+                except Exception as e:
+                    if not can_failover(e):
+                        self.call_stats['failures'] += 1
+                        raise
+                    stats.record_failure()
+                    error = e
+                    continue
+                stats.record_success(time.time() - start)
+                self.finish(request, server, model, i, span)
+                return self
+            self.call_stats['failures'] += 1
+            raise error
+
+    def finish(self, request, server, model, failovers, span):
+        self.current = (server, model)
+        self.response_list.append(request.response_list[-1])
+        self.call_stats['failovers'] += failovers
+        span.update(server=server, model=model, failovers=failovers)
+
+    def fee(self):
+        fees = [request.fee() for request in self.requests.values()]
+        return sum(fee for fee in fees if fee is not None)
+
+    def count_usage(self):
+        for (server, model), request in self.requests.items():
+            print(f'{server}/{model}:')
+            request.count_usage()
+        if self.call_stats['failovers'] or self.call_stats['failures']:
+            print(f"router: {self.call_stats}")
+
+
+if __name__ == '__main__':
+    a = RouterRequest('chat')
+    test_messages = [
+        {'role': 'user',
+         'content': '扮演一只猫'}
+    ]
+    print(a.call(test_messages).read_response()['show_msg'])
+    a.count_usage()
+    print(route_stats())
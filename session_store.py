@@ -0,0 +1,204 @@
+# 持久化的会话记录：Talk.records、Talker.context和Agent.states追加写入磁盘，内核重启后可以恢复，不需要重新调用模型
+# 目录下是若干个段文件（000001.log ...），每条记录是 4字节长度 + 4字节crc32 + json
+# checkpoint是某一时刻完整状态的快照，index.json记录最后一个checkpoint的位置，恢复时从那里读取再重放之后的记录
+# checkpoint之后写入的数据超过阈值时自动压缩：在新的段文件写入checkpoint，删除之前的段
+import json
+import os
+import struct
+import threading
+import zlib
+
+SESSION_CONFIG = {
+    # 单个段文件的大小上限（字节），超过后写入新的段
+    'segment_bytes': 4 * 1024 * 1024,
+    # checkpoint之后写入超过这么多字节（且超过checkpoint本身的大小）时自动压缩
+    'compact_bytes': 16 * 1024 * 1024,
+    # 每次写入后是否fsync，关闭时只flush到操作系统
+    'fsync': False,
+}
+
+HEADER = struct.Struct('>II')
+INDEX_FILE = 'index.json'
+
+
+def segment_name(number):
+    return f'{number:06d}.log'
+
+
+def encode(entry):
+    data = json.dumps(entry, ensure_ascii=False, separators=(',', ':'), default=str).encode('utf-8')
+    return HEADER.pack(len(data), zlib.crc32(data)) + data
+
+
+def read_segment(path, offset=0):
+    """从offset开始读取段文件，返回(entry, 结束位置)的生成器，遇到写了一半或损坏的记录时停止"""
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        while True:
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size:
+                return
+            length, crc = HEADER.unpack(header)
+            data = f.read(length)
+            if len(data) < length or zlib.crc32(data) != crc:
+                return
+            offset += HEADER.size + length
+            yield json.loads(data), offset
+
+
+class SessionStore:
+    """
+    追加写入的会话日志，append是O(1)的，只有checkpoint（包括自动压缩）需要写入完整状态
+    snapshot是返回当前完整状态的函数，由使用者设置，自动压缩时调用；为None时不自动压缩
+    """
+    def __init__(self, path, snapshot=None, segment_bytes=None, compact_bytes=None, fsync=None):
+        self.path = path
+        self.snapshot = snapshot
+        self.segment_bytes = segment_bytes or SESSION_CONFIG['segment_bytes']
+        self.compact_bytes = compact_bytes or SESSION_CONFIG['compact_bytes']
+        self.fsync = SESSION_CONFIG['fsync'] if fsync is None else fsync
+        os.makedirs(path, exist_ok=True)
+
+        self.lock = threading.RLock()
+        self.file = None
+        self.segment = 0
+        # 最后一个checkpoint之后写入的字节数，以及checkpoint本身的大小
+        self.tail_bytes = 0
+        self.checkpoint_bytes = 0
+        self.stats = {'appends': 0, 'checkpoints': 0, 'compactions': 0}
+
+    def segments(self):
+        return sorted(int(name[:-4]) for name in os.listdir(self.path) if name.endswith('.log') and name[:-4].isdigit())
+
+    def segment_path(self, number):
+        return os.path.join(self.path, segment_name(number))
+
+    def read_index(self):
+        try:
+            with open(os.path.join(self.path, INDEX_FILE), encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def write_index(self, segment, offset):
+        index_path = os.path.join(self.path, INDEX_FILE)
+        with open(index_path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump({'segment': segment, 'offset': offset}, f)
+        os.replace(index_path + '.tmp', index_path)
+
+    def exists(self):
+        return bool(self.segments())
+
+    def load(self):
+        """
+        返回(最后一个checkpoint的状态, 之后的记录列表)，没有checkpoint时状态为None
+        index.json缺失或落后时从第一个段开始读，读到的checkpoint会覆盖之前的内容
+        最后一个段末尾不完整的记录会被丢弃，其他段中的损坏抛出ValueError，不会截断之后的记录
+        """
+        with self.lock:
+            segments = self.segments()
+            if not segments:
+                return None, []
+            index = self.read_index()
+            start, offset = segments[0], 0
+            if index and index['segment'] in segments:
+                start, offset = index['segment'], index['offset']
+
+            state = None
+            entries = []
+            end = (start, offset)
+            tail_bytes = 0
+            for number in segments:
+                if number < start:
+                    continue
+                position = offset if number == start else 0
+                path = self.segment_path(number)
+                for entry, position_end in read_segment(path, position):
+                    size = position_end - position
+                    position = position_end
+                    if entry.get('t') == 'checkpoint':
+                        state = entry['state']
+                        entries = []
+                        self.checkpoint_bytes = size
+                        tail_bytes = 0
+                    else:
+                        entries.append(entry)
+                        tail_bytes += size
+                # 只有最后一个段的末尾可能是崩溃时写了一半的记录，之前的段读不完说明文件损坏
+                if number != segments[-1] and position != os.path.getsize(path):
+                    raise ValueError(f'会话记录损坏：{path}在{position}字节处无法读取')
+                end = (number, position)
+            self.tail_bytes = tail_bytes
+            self._open(*end)
+            return state, entries
+
+    def _open(self, segment, offset):
+        """打开最后一个段用于追加，丢弃末尾写了一半的记录"""
+        if self.file:
+            self.file.close()
+        self.segment = segment
+        path = self.segment_path(segment)
+        self.file = open(path, 'r+b' if os.path.exists(path) else 'wb')
+        self.file.truncate(offset)
+        self.file.seek(offset)
+
+    def _ensure_open(self):
+        if self.file is None:
+            segments = self.segments()
+            if not segments:
+                self._open(1, 0)
+            else:
+                # 找到最后一个段中完整记录的结尾
+                end = 0
+                for _, end in read_segment(self.segment_path(segments[-1])):
+                    pass
+                self._open(segments[-1], end)
+
+    def _write(self, data):
+        self.file.write(data)
+        self.file.flush()
+        if self.fsync:
+            os.fsync(self.file.fileno())
+
+    def append(self, entry):
+        with self.lock:
+            self._ensure_open()
+            data = encode(entry)
+            if self.file.tell() and self.file.tell() + len(data) > self.segment_bytes:
+                self._open(self.segment + 1, 0)
+            self._write(data)
+            self.tail_bytes += len(data)
+            self.stats['appends'] += 1
+            if self.snapshot and self.tail_bytes > max(self.compact_bytes, self.checkpoint_bytes):
+                self.compact()
+
+    def checkpoint(self, state):
+        """在新的段中写入完整状态，更新index后删除之前的段"""
+        with self.lock:
+            self._ensure_open()
+            old_segments = [number for number in self.segments() if number <= self.segment]
+            self._open(self.segment + 1, 0)
+            data = encode({'t': 'checkpoint', 'state': state})
+            self._write(data)
+            if not self.fsync:
+                os.fsync(self.file.fileno())
+            self.write_index(self.segment, 0)
+            for number in old_segments:
+                os.remove(self.segment_path(number))
+            self.checkpoint_bytes = len(data)
+            self.tail_bytes = 0
+            self.stats['checkpoints'] += 1
+
+    def compact(self):
+        with self.lock:
+            self.checkpoint(self.snapshot())
+            self.stats['compactions'] += 1
+
+    def size(self):
+        return sum(os.path.getsize(self.segment_path(number)) for number in self.segments())
+
+    def close(self):
+        with self.lock:
+            if self.file:
+                self.file.close()
+                self.file = None
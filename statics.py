@@ -1,5 +1,4 @@
 # 在多个api服务中通用的静态方法
-import requests
 import random
 import pprint
 
@@ -87,12 +86,22 @@ def str_context(context, user_name='', assistant_name=''):
     return str_context
         
 
-def tokens2fee(model, fee_list, prompt_tokens, completion_tokens):
+def compute_fee(model, fee_list, prompt_tokens, completion_tokens, cached_tokens=0):
+    """计算费用，命中上下文缓存的prompt token按cached_fee计算，没有价格的模型返回None"""
+    if model in fee_list.keys():
+        fee = fee_list[model]
+        cached_fee = fee.get('cached_fee', fee['prompt_fee'])
+        return (fee['prompt_fee'] * (prompt_tokens - cached_tokens) + cached_fee * cached_tokens
+                + fee['completion_fee'] * completion_tokens) / 1000
+
+
+def tokens2fee(model, fee_list, prompt_tokens, completion_tokens, cached_tokens=0):
     print(f'prompt_tokens: {prompt_tokens}')
+    if cached_tokens:
+        print(f'cached_tokens: {cached_tokens} ({cached_tokens / prompt_tokens:.1%})')
     print(f'completion_tokens: {completion_tokens}')
-    if model in fee_list.keys():
-        total_fee = (fee_list[model]['prompt_fee'] * prompt_tokens + fee_list[model][
-            'completion_fee'] * completion_tokens) / 1000
+    total_fee = compute_fee(model, fee_list, prompt_tokens, completion_tokens, cached_tokens)
+    if total_fee is not None:
         print(f'total_fee: {total_fee}')
 
 
@@ -100,8 +109,10 @@ def merge_adjacent_messages_with_same_role(messages):
     req_messages = messages.copy()
     for i in range(len(req_messages) - 1, 0, -1):
         if req_messages[i]['role'] == req_messages[i - 1]['role']:
-            # 合并content字段
-            req_messages[i - 1]['content'] += '\n' + req_messages[i]['content']
+            # 合并content字段，复制后再修改
+            # 传入的消息可能来自Talk.get_related_context，和context_index以及Talk.records中的记录共用，原地修改会污染后续轮次
+            merged = dict(req_messages[i - 1], content=req_messages[i - 1]['content'] + '\n' + req_messages[i]['content'])
+            req_messages[i - 1] = merged
             # 现在可以删除当前的消息，因为它已经被合并到前一个消息中了
             del req_messages[i]
     return req_messages
@@ -116,6 +127,8 @@ def remove_no_str_message(messages):
 
 
 def is_image(url):
+    # requests只在这里用到，启动时不导入
+    import requests
     try:
         # 发送HTTP GET请求
         response = requests.get(url)
@@ -0,0 +1,239 @@
+# 调用链追踪：记录Service.respond、Request.call、Talk.map_task_messages、Task.receive等步骤的耗时和属性
+# 没有添加exporter时span()返回一个什么都不做的对象，几乎没有额外开销
+import contextvars
+import functools
+import inspect
+import itertools
+import json
+import os
+import threading
+import time
+
+_exporters = []
+_current = contextvars.ContextVar('current_span', default=None)
+_ids = itertools.count(1)
+
+
+class Span:
+    __slots__ = ('name', 'trace_id', 'span_id', 'parent_id', 'start', 'end', 'attributes', 'status', 'error',
+                 '_token', '_perf')
+
+    def __init__(self, name, attributes):
+        parent = _current.get()
+        self.name = name
+        self.span_id = next(_ids)
+        self.parent_id = parent.span_id if parent else None
+        self.trace_id = parent.trace_id if parent else f'{os.getpid():x}-{self.span_id:x}'
+        self.attributes = attributes
+        self.start = 0
+        self.end = 0
+        self.status = 'ok'
+        self.error = None
+
+    def set(self, key, value):
+        self.attributes[key] = value
+
+    def update(self, **attributes):
+        self.attributes.update(attributes)
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+    def __enter__(self):
+        self._token = _current.set(self)
+        self.start = time.time()
+        self._perf = time.perf_counter()
+        for exporter in _exporters:
+            if hasattr(exporter, 'on_start'):
+                exporter.on_start(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.end = self.start + time.perf_counter() - self._perf
+        if exc is not None:
+            self.status = 'error'
+            self.error = f'{type(exc).__name__}: {exc}'
+        _current.reset(self._token)
+        for exporter in _exporters:
+            exporter.export(self)
+        return False
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'start': self.start,
+            'duration': self.duration,
+            'status': self.status,
+            'error': self.error,
+            'attributes': self.attributes,
+        }
+
+
+class _NoopSpan:
+    """没有开启追踪时使用，所有操作都直接返回"""
+    __slots__ = ()
+
+    def set(self, key, value):
+        pass
+
+    def update(self, **attributes):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+def enabled():
+    return bool(_exporters)
+
+
+def span(name, **attributes):
+    """
+    with tracing.span('Request.call', model=...) as s:
+        s.set('prompt_tokens', ...)
+    """
+    if not _exporters:
+        return NOOP_SPAN
+    return Span(name, attributes)
+
+
+def current():
+    """当前的span，用于在函数内部补充属性，没有时返回NOOP_SPAN"""
+    return _current.get() or NOOP_SPAN
+
+
+def traced(name, attributes=None):
+    """
+    为函数（包括async函数）添加span的装饰器
+    attributes是一个函数，接收被装饰函数的参数，返回span的初始属性
+    """
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                if not _exporters:
+                    return await func(*args, **kwargs)
+                with Span(name, attributes(*args, **kwargs) if attributes else {}):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _exporters:
+                return func(*args, **kwargs)
+            with Span(name, attributes(*args, **kwargs) if attributes else {}):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def wrap(func):
+    """让新线程中的span能找到当前线程的父span，没有开启追踪时原样返回"""
+    if not _exporters:
+        return func
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.run(func, *args, **kwargs)
+
+
+def add_exporter(exporter):
+    _exporters.append(exporter)
+    return exporter
+
+
+def remove_exporter(exporter):
+    if exporter in _exporters:
+        _exporters.remove(exporter)
+
+
+def clear_exporters():
+    _exporters.clear()
+
+
+class InMemoryExporter:
+    """把结束的span保存在列表中，用于调试和测试"""
+    def __init__(self):
+        self.spans = []
+        self.lock = threading.Lock()
+
+    def export(self, span):
+        with self.lock:
+            self.spans.append(span)
+
+    def find(self, name):
+        return [span for span in self.spans if span.name == name]
+
+    def clear(self):
+        with self.lock:
+            self.spans = []
+
+    def summary(self):
+        """按名称汇总次数和耗时"""
+        result = {}
+        for span in self.spans:
+            item = result.setdefault(span.name, {'count': 0, 'total': 0, 'max': 0, 'errors': 0})
+            item['count'] += 1
+            item['total'] += span.duration
+            item['max'] = max(item['max'], span.duration)
+            item['errors'] += span.status == 'error'
+        for item in result.values():
+            item['avg'] = item['total'] / item['count']
+        return result
+
+
+class JsonlExporter:
+    """每个结束的span写入一行json"""
+    def __init__(self, path):
+        self.file = open(path, 'a', encoding='utf-8')
+        self.lock = threading.Lock()
+
+    def export(self, span):
+        line = json.dumps(span.to_dict(), ensure_ascii=False, default=str)
+        with self.lock:
+            self.file.write(line + '\n')
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class OTelExporter:
+    """
+    把span转发给OpenTelemetry，需要安装opentelemetry-api（以及配置好的sdk和exporter）
+    span开始时创建对应的OpenTelemetry span，保持父子关系
+    """
+    def __init__(self, tracer=None, name='multi_talk'):
+        from opentelemetry import trace
+        self.trace = trace
+        self.tracer = tracer or trace.get_tracer(name)
+        self.spans = {}
+        self.lock = threading.Lock()
+
+    def on_start(self, span):
+        with self.lock:
+            parent = self.spans.get(span.parent_id)
+        context = self.trace.set_span_in_context(parent) if parent is not None else None
+        otel_span = self.tracer.start_span(span.name, context=context, start_time=int(span.start * 1e9))
+        with self.lock:
+            self.spans[span.span_id] = otel_span
+
+    def export(self, span):
+        with self.lock:
+            otel_span = self.spans.pop(span.span_id, None)
+        if otel_span is None:
+            return
+        for key, value in span.attributes.items():
+            if value is not None:
+                otel_span.set_attribute(key, value if isinstance(value, (str, bool, int, float)) else str(value))
+        if span.status == 'error':
+            otel_span.set_status(self.trace.Status(self.trace.StatusCode.ERROR, span.error))
+        otel_span.end(end_time=int(span.end * 1e9))